@@ -0,0 +1,60 @@
+"""
+Time the single-sample NormalizationKernel transforms.
+
+Usage:
+    python benchmarks/bench_kernel.py --calls 2000
+
+The kernel is built for all of the common genes, in GTEx order and in a
+shuffled order (which needs a gather), and each transform writes into a
+preallocated output vector. The best mean time per call of --repeats runs
+is reported in microseconds.
+
+"""
+import argparse
+import timeit
+import numpy
+
+from genemunge import normalize
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--calls', type=int, default=2000)
+    parser.add_argument('--repeats', type=int, default=5)
+    parser.add_argument('--identifier', default='symbol')
+    parser.add_argument('--tissue', default='Liver')
+    parser.add_argument('--dtype', default='float64')
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    norm = normalize.Normalizer(identifier=args.identifier)
+    genes = norm.common_genes()
+    random = numpy.random.RandomState(args.seed)
+
+    print('{:>10} {:>8} {:>8} {:>12} {:>8} {:>8}'.format(
+        'order', 'genes', 'tpm', 'clr (scale)', 'clr', 'z_score'))
+    for order in ['gtex', 'shuffled']:
+        if order == 'shuffled':
+            genes = genes[random.permutation(len(genes))]
+        kernel = norm.kernel(genes, tissue=args.tissue, dtype=args.dtype)
+        counts = random.poisson(5, len(genes)).astype(numpy.float64)
+        out = numpy.empty(len(kernel.genes), dtype=kernel.dtype)
+        tpm = kernel.tpm(counts).copy()
+        clr = kernel.clr(tpm, scale=0.5).copy()
+
+        calls = [
+            lambda: kernel.tpm(counts, out=out),
+            lambda: kernel.clr(tpm, out=out, scale=0.5),
+            lambda: kernel.clr(tpm, out=out),
+            lambda: kernel.z_score(clr, out=out),
+            ]
+        microseconds = [1e6 * min(timeit.repeat(call, number=args.calls,
+                                                repeat=args.repeats)) / args.calls
+                        for call in calls]
+        print('{:>10} {:>8} {:>8.1f} {:>12.1f} {:>8.1f} {:>8.1f}'.format(
+            order, len(genes), *microseconds))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,88 @@
+"""
+Time the Normalizer transforms on synthetic counts for several n_jobs.
+
+Usage:
+    python benchmarks/bench_normalize.py --samples 2000 --jobs 1 2 4 8 16 32
+
+The counts have one column for every gene with a GTEx length, so the
+transforms run over the full gene set. The best of --repeats runs is
+reported for each transform and number of threads.
+
+"""
+import argparse
+import os
+import time
+import numpy
+import pandas
+
+from genemunge import normalize
+
+
+def best_time(function, repeats):
+    """
+    Get the fastest wall time of repeated calls to a function.
+
+    Args:
+        function (callable): a function without arguments
+        repeats (int): the number of calls
+
+    Returns:
+        float: seconds
+
+    """
+    times = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        function()
+        times.append(time.perf_counter() - start)
+    return min(times)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--samples', type=int, default=2000)
+    parser.add_argument('--genes', type=int, default=None,
+                        help='the number of genes; all GTEx genes if not given')
+    parser.add_argument('--jobs', type=int, nargs='+', default=[1, 2, 4])
+    parser.add_argument('--repeats', type=int, default=3)
+    parser.add_argument('--identifier', default='ensembl_gene_id')
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    norm = normalize.Normalizer(identifier=args.identifier)
+    genes = norm.common_genes()
+    if args.genes is not None:
+        genes = genes[:args.genes]
+    tissues = norm.describer.get_reference('mean_clr').columns
+
+    random = numpy.random.RandomState(args.seed)
+    counts = pandas.DataFrame(
+        random.poisson(5, size=(args.samples, len(genes))).astype(numpy.float64),
+        index=['sample_{}'.format(i) for i in range(args.samples)],
+        columns=genes)
+    sample_tissues = pandas.Series(numpy.resize(tissues, args.samples),
+                                   index=counts.index)
+    # impute once so that clr_from_tpm times the transform, not the imputer
+    tpm = normalize.impute(norm.tpm_from_counts(counts))
+    clr = norm.clr_from_tpm(tpm)
+
+    print('{} samples x {} genes, {} cpus'.format(
+        args.samples, len(genes), os.cpu_count()))
+    print('{:>20} {:>6} {:>10} {:>8}'.format('transform', 'n_jobs', 'seconds', 'speedup'))
+    transforms = [
+        ('tpm_from_counts', lambda n: norm.tpm_from_counts(counts, n_jobs=n)),
+        ('clr_from_tpm', lambda n: norm.clr_from_tpm(tpm, n_jobs=n)),
+        ('z_score_from_clr', lambda n: norm.z_score_from_clr(clr, sample_tissues, n_jobs=n)),
+        ]
+    for name, transform in transforms:
+        serial = None
+        for n_jobs in args.jobs:
+            seconds = best_time(lambda: transform(n_jobs), args.repeats)
+            serial = seconds if serial is None else serial
+            print('{:>20} {:>6} {:>10.3f} {:>8.2f}'.format(
+                name, n_jobs, seconds, serial / seconds))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,68 @@
+"""
+Time the reindex plan cache of the Normalizer.
+
+Usage:
+    python benchmarks/bench_reindex_plan.py --repeats 20
+
+A cache hit with the same column object, a cache hit with equal copies of
+the labels, and a rebuilt plan (plan_cache_size=0) are compared with a
+plain pandas get_indexer over all of the GTEx genes.
+
+"""
+import argparse
+import time
+import warnings
+import pandas
+
+from genemunge import normalize
+
+
+def mean_time(function, repeats):
+    """
+    Get the mean wall time of repeated calls to a function.
+
+    Args:
+        function (callable): a function without arguments
+        repeats (int): the number of calls
+
+    Returns:
+        float: seconds
+
+    """
+    start = time.perf_counter()
+    for _ in range(repeats):
+        function()
+    return (time.perf_counter() - start) / repeats
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--repeats', type=int, default=20)
+    parser.add_argument('--identifier', default='ensembl_gene_id')
+    args = parser.parse_args()
+
+    norm = normalize.Normalizer(identifier=args.identifier)
+    rebuild = normalize.Normalizer(identifier=args.identifier, plan_cache_size=0)
+    columns = pandas.Index(list(norm.common_genes())[::-1])
+    gene_list = list(columns)
+    common_genes = norm.common_genes()
+    norm._reindex_plan(columns, columns)
+    norm._reindex_plan(columns, gene_list)
+
+    cases = [
+        ('get_indexer', lambda: columns.get_indexer(common_genes)),
+        ('cache hit (same)', lambda: norm._reindex_plan(columns, columns)),
+        ('cache hit (equal)', lambda: norm._reindex_plan(columns.copy(), gene_list)),
+        ('rebuild', lambda: rebuild._reindex_plan(columns, gene_list)),
+        ]
+    print('{} genes'.format(len(columns)))
+    print('{:>20} {:>10}'.format('case', 'ms'))
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore')
+        for name, function in cases:
+            print('{:>20} {:>10.3f}'.format(name, 1000 * mean_time(function, args.repeats)))
+
+
+if __name__ == '__main__':
+    main()
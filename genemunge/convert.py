@@ -173,8 +173,4 @@ class IDConverter(object):
             List[str]: list of converted gene identifiers
 
         """
-        good_keys = self.conversion_table.index.intersection(ids)
-        converted = list(self.conversion_table.loc[good_keys][self.target])
-        tmp = pandas.DataFrame(numpy.full(len(ids), numpy.NaN), index=ids)
-        tmp.loc[good_keys] = converted
-        return list(tmp[0])
+        return list(self.conversion_table[self.target].reindex(ids))
@@ -4,6 +4,7 @@ import numpy
 
 from ... import normalize
 from ... import convert
+from ... import describe
 
 
 def hellinger(aves, stds):
@@ -44,7 +45,24 @@ def max_hellinger(aves, stds):
     return numpy.max(hellinger(aves, stds))
 
 
-def create_tissue_stats():
+def quantile_sketch(data, num_quantiles):
+    """
+    Compute evenly spaced quantiles of each column of the data.
+
+    Args:
+        data (pandas.DataFrame ~ (num_samples, num_genes))
+        num_quantiles (int): the number of quantiles, including the
+            minimum and maximum.
+
+    Returns:
+        numpy array ~ (num_genes, num_quantiles)
+
+    """
+    q = numpy.linspace(0, 1, num_quantiles)
+    return numpy.percentile(data.values, 100 * q, axis=0).T
+
+
+def create_tissue_stats(num_quantiles=101):
     """
     Uses data from the GTEx project to estimate statistics of gene expression
     across tissues.
@@ -52,8 +70,13 @@ def create_tissue_stats():
     Expression is measured in Transcripts per Million (TPM).
     Statistics are saved in csv format in the __file__ directory.
 
+    A sketch of the distribution of each gene in each tissue is also saved,
+    as evenly spaced quantiles stored in float16. The 'quantiles' are of
+    log(1 + TPM), which fits in float16, and the 'quantiles_clr' are of the
+    CLR data. The columns of the sketches are (tissue, quantile).
+
     Args:
-        None
+        num_quantiles (optional; int): the number of quantiles in the sketch.
 
     Returns:
         None
@@ -77,6 +100,9 @@ def create_tissue_stats():
     lower_quartile_clr = pandas.DataFrame()
     upper_quartile_clr = pandas.DataFrame()
 
+    quantiles = {}
+    quantiles_clr = {}
+
     tissues = samples.groupby('smts').groups
     norm = normalize.Normalizer('ensembl_gene_id')
     for t in tissues:
@@ -107,6 +133,8 @@ def create_tissue_stats():
         fraction_zero = pandas.concat([
                 fraction_zero, pandas.DataFrame(
                         (tpm == 0).mean().astype(float), columns=[t])], axis=1)
+        quantiles[t] = pandas.DataFrame(
+                quantile_sketch(numpy.log1p(tpm), num_quantiles), index=tpm.columns)
         # Convert tpms to clr with 0.5*min imputation
         clr = norm.clr_from_tpm(tpm, imputer=normalize.impute)
         mean_clr = pandas.concat(
@@ -121,6 +149,8 @@ def create_tissue_stats():
         upper_quartile_clr = pandas.concat(
                 [upper_quartile_clr, pandas.DataFrame(
                         clr.quantile(q=0.75, axis=0)).rename(columns={0.75: t})], axis=1)
+        quantiles_clr[t] = pandas.DataFrame(
+                quantile_sketch(clr, num_quantiles), index=clr.columns)
 
     # compute the maximum pairwise hellinger distance across tissues for each gene
     genes = list(mean.index)
@@ -152,3 +182,57 @@ def create_tissue_stats():
         store.put('lower_quartile_clr', lower_quartile_clr.astype(numpy.float32))
         store.put('upper_quartile_clr', upper_quartile_clr.astype(numpy.float32))
         store.put('hellinger_clr', hellinger_clr.astype(numpy.float32))
+    # the sketches are ~350 MB each uncompressed, so they are written
+    # through a compressed handle (fixed format only compresses per store)
+    with pandas.HDFStore(os.path.join(filepath, 'tissue_stats.h5'), 'a',
+                         complevel=9, complib='blosc') as store:
+        store.put('quantiles', pandas.concat(quantiles, axis=1).astype(numpy.float16))
+        store.put('quantiles_clr', pandas.concat(quantiles_clr, axis=1).astype(numpy.float16))
+
+
+def create_specificity_index():
+    """
+    Uses the statistics in tissue_stats.h5 to rank the genes in each tissue
+    by several scores of tissue specificity (see describe.tissue_specificity).
+
+    The positions of the genes, sorted from most to least specific, are saved
+    in tissue_specificity.h5 in the __file__ directory.
+
+    Args:
+        None
+
+    Returns:
+        None
+
+    """
+    filepath = os.path.dirname(os.path.abspath(__file__))
+    tissue_stats = os.path.join(filepath, 'tissue_stats.h5')
+    mean = pandas.read_hdf(tissue_stats, 'mean')
+    mean_clr = pandas.read_hdf(tissue_stats, 'mean_clr')
+    scores = describe.tissue_specificity(mean, mean_clr)
+
+    with pandas.HDFStore(os.path.join(filepath, 'tissue_specificity.h5'), 'w') as store:
+        store.put('genes', pandas.Series(mean.index))
+        for k in describe.Describer.__specificity__:
+            store.put('order/' + k, describe.rank_tissue_specificity(scores[k]))
+
+
+def create_profile_index():
+    """
+    Uses the mean CLR expression in tissue_stats.h5 to create the normalized
+    expression profiles used for nearest neighbor searches between genes
+    (see describe.normalize_profiles).
+
+    The profiles are saved in tissue_profiles.h5 in the __file__ directory.
+
+    Args:
+        None
+
+    Returns:
+        None
+
+    """
+    filepath = os.path.dirname(os.path.abspath(__file__))
+    mean_clr = pandas.read_hdf(os.path.join(filepath, 'tissue_stats.h5'), 'mean_clr')
+    with pandas.HDFStore(os.path.join(filepath, 'tissue_profiles.h5'), 'w') as store:
+        store.put('profiles', describe.normalize_profiles(mean_clr))
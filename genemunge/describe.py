@@ -1,7 +1,15 @@
 import os
+import threading
+import warnings
 import pandas
 import numpy
+from collections.abc import Mapping
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from scipy.optimize import nnls
 from matplotlib import pyplot as plt
+from matplotlib.figure import Figure
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+from matplotlib.backends.backend_pdf import PdfPages
 
 
 from . import convert
@@ -12,13 +20,310 @@ datapath = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'data')
 gtexpath = os.path.join(datapath, 'gtex')
 
 
+class TissueStats(Mapping):
+    """
+    A read-only mapping from statistic names to per-tissue statistics from GTEx.
+    Each table is read from the HDF5 file the first time that it is accessed.
+
+    Attributes:
+        filename (str): path to the HDF5 file holding the statistics.
+
+    """
+    def __init__(self, filename, keys):
+        """
+        Create a lazy mapping of tissue statistics.
+
+        Args:
+            filename (str): path to the HDF5 file holding the statistics.
+            keys (List[str]): names of the tables in the file.
+
+        Returns:
+            TissueStats
+
+        """
+        self.filename = filename
+        self._keys = list(keys)
+        self._tables = {}
+        # HDF5 reads are serialized because pytables is not thread safe
+        self._lock = threading.Lock()
+        self._preloading = None
+
+    def __getstate__(self):
+        # the lock and any preloading thread cannot be pickled, and the
+        # tables are read again from the file when they are needed
+        state = self.__dict__.copy()
+        state['_tables'] = {}
+        state['_lock'] = None
+        state['_preloading'] = None
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._lock = threading.Lock()
+
+    def __getitem__(self, key):
+        if key not in self._keys:
+            raise KeyError(key)
+        with self._lock:
+            if key not in self._tables:
+                self._tables[key] = pandas.read_hdf(self.filename, key)
+        return self._tables[key]
+
+    def __iter__(self):
+        return iter(self._keys)
+
+    def __len__(self):
+        return len(self._keys)
+
+    def is_loaded(self, key):
+        """
+        Check if a table has already been read from disk.
+
+        Args:
+            key (str): name of the statistic.
+
+        Returns:
+            bool
+
+        """
+        return key in self._tables
+
+    def preload(self, keys=None):
+        """
+        Read tables in a background thread so that they are available
+        by the time that they are first accessed.
+
+        Args:
+            keys (optional; List[str]): names of the tables to read.
+                If None, all of the tables are read.
+
+        Returns:
+            None
+
+        """
+        keys = self._keys if keys is None else keys
+        executor = ThreadPoolExecutor(max_workers=1)
+        self._preloading = executor.submit(lambda: [self[k] for k in keys])
+        executor.shutdown(wait=False)
+
+    def wait(self):
+        """
+        Block until any tables being preloaded have been read.
+
+        Args:
+            None
+
+        Returns:
+            None
+
+        """
+        if self._preloading is not None:
+            self._preloading.result()
+            self._preloading = None
+
+
+def tissue_boxplot_stats(panel):
+    """
+    Compute the boxes and whiskers used to plot expression across tissues
+    from a panel of tissue statistics for many genes at once.
+    Whiskers are placed 1.5 standard deviations from the mean, and the lower
+    whisker is clamped at 0 expression.
+
+    Args:
+        panel (numpy array ~ (num_genes, num_tissues, 5)): the 'mean', 'median',
+            'std', 'lower_quartile' and 'upper_quartile' statistics.
+
+    Returns:
+        numpy array ~ (num_genes, num_tissues, 5): the lower whisker,
+            lower quartile, median, upper quartile and upper whisker.
+
+    """
+    mean, median, std, lower_quartile, upper_quartile = numpy.moveaxis(panel, -1, 0)
+    lower_whisker = numpy.maximum(0, mean - 1.5 * std)
+    upper_whisker = mean + 1.5 * std
+    return numpy.stack([lower_whisker, lower_quartile, median, upper_quartile,
+                        upper_whisker], axis=-1)
+
+
+def _draw_tissue_expression(ax, title, tissues, boxes):
+    """
+    Draw precomputed boxes and whiskers for the expression of a gene
+    across tissues.
+
+    Args:
+        ax (matplotlib.axes.Axes)
+        title (str)
+        tissues (List[str])
+        boxes (numpy array ~ (num_tissues, 5)): from tissue_boxplot_stats.
+
+    Returns:
+        None
+
+    """
+    ax.bxp([{'whislo': b[0], 'q1': b[1], 'med': b[2], 'q3': b[3], 'whishi': b[4]}
+            for b in boxes], showfliers=False)
+    min_y, max_y = boxes[:, 0].min(), boxes[:, 4].max()
+    ax.set_ylim([min_y - 0.1 * min_y, max_y + 0.1 * max_y])
+    ax.set_xticks(numpy.arange(len(tissues)) + 1)
+    ax.set_xticklabels(tissues, rotation='vertical')
+    ax.set_title(title)
+    ax.set_ylabel('TPM')
+
+
+def _tissue_expression_figure(title, tissues, boxes):
+    """
+    Create a figure of the expression of a gene across tissues
+    without using the pyplot state machine.
+
+    Args:
+        title (str)
+        tissues (List[str])
+        boxes (numpy array ~ (num_tissues, 5)): from tissue_boxplot_stats.
+
+    Returns:
+        matplotlib.figure.Figure
+
+    """
+    fig = Figure(figsize=(10, 4))
+    FigureCanvasAgg(fig)
+    _draw_tissue_expression(fig.add_subplot(111), title, tissues, boxes)
+    fig.tight_layout()
+    return fig
+
+
+def _save_tissue_expression(job):
+    """
+    Save a figure of the expression of a gene across tissues.
+    Used by the worker processes in Describer.plot_tissue_expression_batch.
+
+    Args:
+        job (tuple): filename, title, tissues, boxes and dpi.
+
+    Returns:
+        filename (str)
+
+    """
+    filename, title, tissues, boxes, dpi = job
+    fig = _tissue_expression_figure(title, tissues, boxes)
+    fig.savefig(filename, bbox_inches='tight', dpi=dpi)
+    return filename
+
+
+def tissue_specificity(mean, mean_clr):
+    """
+    Compute scores that describe how specifically each gene is expressed
+    in each tissue. Higher scores are more specific.
+        mean: the mean TPM in the tissue
+        fraction: the fraction of the summed mean TPM across tissues
+        zscore: the z-score of the mean TPM relative to the other tissues
+        zscore_clr: the z-score of the mean CLR relative to the other tissues
+
+    Args:
+        mean (pandas.DataFrame ~ (num_genes, num_tissues)): mean TPM
+        mean_clr (pandas.DataFrame ~ (num_genes, num_tissues)): mean CLR
+
+    Returns:
+        dict{str: pandas.DataFrame ~ (num_genes, num_tissues)}
+
+    """
+    def zscore(x):
+        centered = x - x.mean(axis=1, keepdims=True)
+        std = x.std(axis=1, keepdims=True)
+        return numpy.divide(centered, std, out=numpy.zeros_like(centered),
+                            where=std > 0)
+
+    values = mean.values.astype(numpy.float64)
+    values_clr = mean_clr.reindex(index=mean.index, columns=mean.columns).values
+    total = values.sum(axis=1, keepdims=True)
+    scores = {
+        'mean': values,
+        'fraction': numpy.divide(values, total, out=numpy.zeros_like(values),
+                                 where=total > 0),
+        'zscore': zscore(values),
+        'zscore_clr': zscore(values_clr.astype(numpy.float64))
+        }
+    return {k: pandas.DataFrame(v, index=mean.index, columns=mean.columns)
+            for k, v in scores.items()}
+
+
+def rank_tissue_specificity(scores):
+    """
+    Sort the genes in each tissue from the most to the least specific.
+
+    Args:
+        scores (pandas.DataFrame ~ (num_genes, num_tissues))
+
+    Returns:
+        order (pandas.DataFrame ~ (num_genes, num_tissues)): the i-th row holds
+            the position of the i-th most specific gene in each tissue.
+
+    """
+    values = numpy.where(numpy.isnan(scores.values), -numpy.inf, scores.values)
+    order = numpy.argsort(-values, axis=0, kind='mergesort').astype(numpy.int32)
+    return pandas.DataFrame(order, columns=scores.columns)
+
+
+def normalize_profiles(profiles):
+    """
+    Center the expression profile of each gene across tissues and scale it
+    to unit length, so that the dot product of two profiles is their
+    Pearson correlation.
+    Profiles with no variation are set to zero.
+
+    Args:
+        profiles (pandas.DataFrame ~ (num_genes, num_tissues))
+
+    Returns:
+        pandas.DataFrame ~ (num_genes, num_tissues): float32 profiles
+
+    """
+    values = numpy.nan_to_num(profiles.values.astype(numpy.float64))
+    values -= values.mean(axis=1, keepdims=True)
+    norms = numpy.sqrt((values**2).sum(axis=1, keepdims=True))
+    values = numpy.divide(values, norms, out=numpy.zeros_like(values), where=norms > 0)
+    return pandas.DataFrame(values.astype(numpy.float32), index=profiles.index,
+                            columns=profiles.columns)
+
+
+def _nnls_rows(R, B):
+    """
+    Solve a non-negative least squares problem min_p ||R p - b||, p >= 0,
+    for every row b of B.
+    Used by the worker processes in Describer.deconvolve.
+
+    Args:
+        R (numpy array ~ (num_tissues, num_tissues))
+        B (numpy array ~ (num_samples, num_tissues))
+
+    Returns:
+        P (numpy array ~ (num_samples, num_tissues)),
+        residual norms (numpy array ~ (num_samples,))
+
+    """
+    P = numpy.empty_like(B)
+    residuals = numpy.empty(len(B))
+    for i, b in enumerate(B):
+        P[i], residuals[i] = nnls(R, b)
+    return P, residuals
+
+
 class Describer(object):
     """
     A descriptor for genes.
     Includes statistics on gene expression in healthy tissue from GTEx.
 
+    The converters, the searcher and the tables of tissue statistics are
+    only created when they are first used.
+
     Attributes:
         __stats__ (List[str]): a class attribute holding statistic names.
+        __boxplot_stats__ (List[str]): a class attribute holding the names of
+            the statistics used to plot expression.
+        __specificity__ (List[str]): a class attribute holding the names of
+            the tissue specificity scores.
+        __quantiles__ (List[str]): a class attribute holding the names of the
+            per-tissue quantile sketches, which are not preloaded.
+        identifier (str): the type of gene identifier used by the Describer.
         get_ensembl (callable): an instance of convert.IDConverter.convert
             to get the Ensembl ID.
         get_name (callable): an instance of convert.IDConverter.convert
@@ -26,7 +331,7 @@ class Describer(object):
         get_symbol (callable): an instance of convert.IDConverter.convert
             to get the gene symbol.
         searcher (Searcher): an instance of search.Searcher to get gene info.
-        tissue_stats (dict{str: DataFrame}): per-tissue statistics from GTEx.
+        tissue_stats (TissueStats or HDFStore): per-tissue statistics from GTEx.
 
     """
 
@@ -34,36 +339,503 @@ class Describer(object):
                  'fraction_zero', 'hellinger', 'mean_clr', 'median_clr', 'std_clr',
                  'lower_quartile_clr', 'upper_quartile_clr', 'hellinger_clr']
 
-    def __init__(self, identifier='symbol', load_tissue_data=True):
+    __boxplot_stats__ = ['mean', 'median', 'std', 'lower_quartile', 'upper_quartile']
+
+    __specificity__ = ['mean', 'fraction', 'zscore', 'zscore_clr']
+
+    __quantiles__ = ['quantiles', 'quantiles_clr']
+
+    def __init__(self, identifier='symbol', load_tissue_data=True, preload=False):
         """
         Create an object to grab the information that describes a gene.
 
         Args:
             identifier (optional; str): the type of gene identifier you will use
                 e.g., 'symbol', 'ensembl_gene_id'
+            load_tissue_data (optional; bool): if True, tables of tissue
+                statistics are read into memory on first access. if False,
+                they are served from an open HDF5 store.
+            preload (optional; bool): if True, read all of the tables of tissue
+                statistics in a background thread.
 
         Returns:
             Describer
 
         """
-        if identifier is not 'ensembl_gene_id':
-            self.get_ensembl = convert.IDConverter(identifier, 'ensembl_gene_id').convert
-        else:
-            self.get_ensembl = convert.clean_ensembl_id
-        self.get_name = convert.IDConverter('ensembl_gene_id', 'name').convert
-        self.get_symbol = convert.IDConverter('ensembl_gene_id', 'symbol').convert
-        self.searcher = search.Searcher()
+        self.identifier = identifier
+        self._converters = {}
+        self._searcher = None
+        self._specificity = None
+        self._reference_index = None
+        self._profiles = None
+        self._references = {}
         tissue_status_filename = os.path.join(gtexpath, 'tissue_stats.h5')
         if load_tissue_data:
-            self.tissue_stats = {}
-            for k in self.__stats__:
-                self.tissue_stats[k] = pandas.read_hdf(tissue_status_filename, k)
+            self.tissue_stats = TissueStats(tissue_status_filename,
+                                            self.__stats__ + self.__quantiles__)
+            if preload:
+                self.tissue_stats.preload(self.__stats__)
         else:
             self.tissue_stats = pandas.HDFStore(tissue_status_filename)
 
+    def _converter(self, source, target):
+        """
+        Get an IDConverter, creating it on first use.
+
+        Args:
+            source (str): the id type to convert
+            target (str): the desired id type
+
+        Returns:
+            IDConverter
+
+        """
+        if (source, target) not in self._converters:
+            self._converters[(source, target)] = convert.IDConverter(source, target)
+        return self._converters[(source, target)]
+
+    @property
+    def get_ensembl(self):
+        if self.identifier == 'ensembl_gene_id':
+            return convert.clean_ensembl_id
+        return self._converter(self.identifier, 'ensembl_gene_id').convert
+
+    @property
+    def get_name(self):
+        return self._converter('ensembl_gene_id', 'name').convert
+
+    @property
+    def get_symbol(self):
+        return self._converter('ensembl_gene_id', 'symbol').convert
+
+    @property
+    def searcher(self):
+        if self._searcher is None:
+            self._searcher = search.Searcher()
+        return self._searcher
+
+    @property
+    def tissues(self):
+        """
+        The names of the GTEx tissues.
+
+        Args:
+            None
+
+        Returns:
+            List[str]
+
+        """
+        return list(self.tissue_stats['mean'].columns)
+
+    def _to_ensembl(self, gene_identifiers):
+        """
+        Convert a list of gene identifiers to Ensembl IDs.
+        Unknown identifiers are converted to NaN.
+
+        Args:
+            gene_identifiers (List[str])
+
+        Returns:
+            List[str]
+
+        """
+        if self.identifier == 'ensembl_gene_id':
+            return convert.clean_ensembl_ids(gene_identifiers)
+        converter = self._converter(self.identifier, 'ensembl_gene_id')
+        return converter.convert_list(list(gene_identifiers))
+
+    def _from_ensembl(self, index):
+        """
+        Convert an index of Ensembl IDs to the identifier used by the Describer.
+        Genes that cannot be converted, and any duplicates, are not kept.
+
+        Args:
+            index (pandas.Index): Ensembl IDs
+
+        Returns:
+            labels (pandas.Index): the converted identifiers of every gene
+            keep (numpy array ~ (num_genes,)): whether each gene is kept
+
+        """
+        if self.identifier == 'ensembl_gene_id':
+            labels = pandas.Index(index)
+        else:
+            converter = self._converter('ensembl_gene_id', self.identifier)
+            labels = pandas.Index(converter.convert_list(list(index)))
+        keep = labels.notnull() & ~labels.duplicated(keep='first')
+        return labels, numpy.asarray(keep)
+
+    def get_reference(self, stat, gene_list=None):
+        """
+        Get a table of per-tissue statistics (or quantile sketches) from GTEx
+        indexed by the identifier used by the Describer.
+        Genes that cannot be converted are dropped, as are any duplicates.
+        The converted tables are cached.
+
+        Args:
+            stat (str): one of Describer.__stats__ or Describer.__quantiles__
+            gene_list (optional; List[str]): a list of gene ids to reindex to.
+                Genes that are not in GTEx are filled with NaN.
+
+        Returns:
+            pandas.DataFrame ~ (num_genes, num_tissues)
+
+        """
+        if stat not in self._references:
+            if self._reference_index is None:
+                index = self.tissue_stats['mean'].index
+                labels, keep = self._from_ensembl(index)
+                self._reference_index = (index, numpy.flatnonzero(keep), labels[keep])
+            index, positions, labels = self._reference_index
+            table = self.tissue_stats[stat]
+            if not table.index.equals(index):
+                table = table.reindex(index)
+            self._references[stat] = pandas.DataFrame(
+                    table.values[positions], index=labels, columns=table.columns)
+        if gene_list is None:
+            return self._references[stat]
+        return self._references[stat].reindex(gene_list)
+
+    def tissue_log_likelihood(self, data, gene_list=None, chunk_size=1000):
+        """
+        Compute the log-likelihood of each sample under a Gaussian model of
+        the CLR expression of every GTEx tissue, treating genes as independent.
+
+        For a tissue with means mu and standard deviations sigma,
+            -2 log L = sum_g (x_g^2 - 2 x_g mu_g + mu_g^2) / sigma_g^2
+                       + sum_g log(2 pi sigma_g^2),
+        so the log-likelihoods of a chunk of samples for all tissues are
+        computed with two matrix products.
+        Genes that are missing from GTEx or have zero variance are ignored.
+
+        Args:
+            data (pandas.DataFrame ~ (num_samples, num_genes)): CLR data
+            gene_list (optional; List[str]): a list of gene ids
+            chunk_size (optional; int): the number of samples per chunk.
+
+        Returns:
+            pandas.DataFrame ~ (num_samples, num_tissues)
+
+        """
+        genes = data.columns if gene_list is None else pandas.Index(gene_list)
+        mean = self.get_reference('mean_clr', genes).values.astype(numpy.float64)
+        std = self.get_reference('std_clr', genes).values.astype(numpy.float64)
+        valid = (numpy.isfinite(mean) & numpy.isfinite(std) & (std > 0)).all(axis=1)
+        valid &= genes.isin(data.columns)
+        genes, mean, std = genes[valid], mean[valid].T, std[valid].T
+        precision = 1 / std**2
+        weighted_mean = mean * precision
+        const = (mean * weighted_mean).sum(axis=1) \
+                + numpy.log(2 * numpy.pi * std**2).sum(axis=1)
+
+        columns = data.columns.get_indexer(genes)
+        values = data.values
+        log_likelihood = numpy.empty((len(data), mean.shape[0]))
+        for start in range(0, len(data), chunk_size):
+            x = numpy.asarray(values[start:start+chunk_size][:, columns],
+                              dtype=numpy.float64)
+            chunk = numpy.dot(x**2, precision.T)
+            chunk -= 2 * numpy.dot(x, weighted_mean.T)
+            chunk += const
+            log_likelihood[start:start+chunk_size] = -0.5 * chunk
+        return pandas.DataFrame(log_likelihood, index=data.index,
+                                columns=self.get_reference('mean_clr').columns)
+
+    def classify_tissue(self, data, tissues=None, gene_list=None, chunk_size=1000):
+        """
+        Find the GTEx tissue that best describes the CLR expression of each
+        sample (see tissue_log_likelihood).
+
+        The margin is the difference in log-likelihood between the best and
+        second best tissues. If the declared tissues of the samples are given,
+        the rank of the declared tissue (0 is the best) and its difference in
+        log-likelihood from the best tissue are also returned.
+
+        Args:
+            data (pandas.DataFrame ~ (num_samples, num_genes)): CLR data
+            tissues (optional; pandas.Series ~ (num_samples)): declared tissues
+            gene_list (optional; List[str]): a list of gene ids
+            chunk_size (optional; int): the number of samples per chunk.
+
+        Returns:
+            pandas.DataFrame ~ (num_samples, 4 or 6)
+
+        """
+        log_likelihood = self.tissue_log_likelihood(data, gene_list, chunk_size)
+        values = log_likelihood.values
+        ranked = numpy.argsort(-values, axis=1)
+        rows = numpy.arange(len(values))
+        names = numpy.array(log_likelihood.columns)
+        best = values[rows, ranked[:, 0]]
+        result = pandas.DataFrame({
+            'tissue': names[ranked[:, 0]],
+            'log_likelihood': best,
+            'runner_up': names[ranked[:, 1]],
+            'margin': best - values[rows, ranked[:, 1]]
+            }, index=data.index,
+            columns=['tissue', 'log_likelihood', 'runner_up', 'margin'])
+        if tissues is not None:
+            declared = log_likelihood.columns.get_indexer(tissues.reindex(data.index))
+            assert (declared >= 0).all(), "Unknown tissues in declared tissues"
+            result['declared_rank'] = (ranked == declared[:, None]).argmax(axis=1)
+            result['declared_margin'] = best - values[rows, declared]
+        return result
+
+    def deconvolve(self, data, gene_list=None, chunk_size=1000, n_jobs=1):
+        """
+        Estimate the proportions of GTEx tissues that make up each sample
+        by non-negative least squares against the mean TPM of the tissues.
+
+        The reference matrix A ~ (num_genes, num_tissues) is factorized once
+        as A = Q R. Since ||A p - y||^2 = ||R p - Q^T y||^2 + ||y||^2 - ||Q^T y||^2,
+        each sample only needs a small num_tissues x num_tissues problem,
+        and Q^T y is computed for a chunk of samples with one matrix product.
+        Chunks are solved by n_jobs processes.
+        Genes that are missing from GTEx are ignored.
+
+        Args:
+            data (pandas.DataFrame ~ (num_samples, num_genes)): TPM data
+            gene_list (optional; List[str]): a list of gene ids
+            chunk_size (optional; int): the number of samples per chunk.
+            n_jobs (optional; int): the number of processes.
+
+        Returns:
+            proportions (pandas.DataFrame ~ (num_samples, num_tissues)),
+            residuals (pandas.Series ~ (num_samples,)): the norm of the residual
+                relative to the norm of the sample.
+
+        """
+        genes = data.columns if gene_list is None else pandas.Index(gene_list)
+        reference = self.get_reference('mean', genes)
+        valid = numpy.isfinite(reference.values).all(axis=1) & genes.isin(data.columns)
+        genes = genes[valid]
+        Q, R = numpy.linalg.qr(reference.values[valid].astype(numpy.float64))
+
+        columns = data.columns.get_indexer(genes)
+        values = data.values
+        chunks, norms = [], []
+        for start in range(0, len(data), chunk_size):
+            y = numpy.asarray(values[start:start+chunk_size][:, columns],
+                              dtype=numpy.float64)
+            chunks.append(numpy.dot(y, Q))
+            norms.append((y**2).sum(axis=1))
+
+        if n_jobs == 1:
+            solved = [_nnls_rows(R, B) for B in chunks]
+        else:
+            with ProcessPoolExecutor(max_workers=n_jobs) as executor:
+                solved = list(executor.map(_nnls_rows, [R] * len(chunks), chunks))
+
+        coefficients = numpy.concatenate([P for P, _ in solved])
+        reduced = numpy.concatenate([r for _, r in solved])
+        projected = numpy.concatenate([(B**2).sum(axis=1) for B in chunks])
+        norms = numpy.concatenate(norms)
+        residuals = numpy.sqrt(numpy.maximum(reduced**2 + norms - projected, 0))
+        residuals = numpy.divide(residuals, numpy.sqrt(norms),
+                                 out=numpy.zeros_like(residuals), where=norms > 0)
+
+        totals = coefficients.sum(axis=1, keepdims=True)
+        proportions = numpy.divide(coefficients, totals,
+                                   out=numpy.zeros_like(coefficients), where=totals > 0)
+        return (pandas.DataFrame(proportions, index=data.index,
+                                 columns=reference.columns),
+                pandas.Series(residuals, index=data.index))
+
+    def _load_profiles(self):
+        """
+        Load the normalized CLR expression profiles from tissue_profiles.h5,
+        or compute them from the tissue statistics if the file does not exist.
+
+        Args:
+            None
+
+        Returns:
+            pandas.DataFrame ~ (num_genes, num_tissues)
+
+        """
+        if self._profiles is None:
+            filename = os.path.join(gtexpath, 'tissue_profiles.h5')
+            if os.path.exists(filename):
+                self._profiles = pandas.read_hdf(filename, 'profiles')
+            else:
+                self._profiles = normalize_profiles(self.tissue_stats['mean_clr'])
+        return self._profiles
+
+    def get_similar_genes(self, gene_identifiers, k=10, block_size=8192):
+        """
+        Find the genes whose mean CLR expression across GTEx tissues is most
+        correlated with that of each query gene.
+
+        The search is exact. The queries are compared to blocks of genes with
+        one matrix product per block while keeping a running top-k.
+
+        Only the genes that have an identifier of the type used by the
+        Describer are searched.
+
+        Args:
+            gene_identifiers (List[str]): the identifiers for the query genes.
+            k (optional; int): the number of neighbors of each gene.
+            block_size (optional; int): the number of genes per block.
+
+        Returns:
+            List[pandas.Series]: for each query, in order, the correlations of
+                its neighbors indexed by the identifier. The Series are empty
+                for unknown queries.
+
+        """
+        profiles = self._load_profiles()
+        labels, keep = self._from_ensembl(profiles.index)
+        vectors = profiles.values[keep]
+        labels = labels[keep]
+        queries = list(gene_identifiers)
+        if self.identifier == 'ensembl_gene_id':
+            queries = convert.clean_ensembl_ids(queries)
+        positions = labels.get_indexer(queries)
+        known = positions >= 0
+        if not known.all():
+            warnings.warn("Could not find identifiers: {}".format(
+                    [g for g, k in zip(gene_identifiers, known) if not k]))
+        positions = positions[known]
+        query_vectors = vectors[positions]
+        rows = numpy.arange(len(positions))[:, None]
+
+        best = numpy.full((len(positions), 0), -numpy.inf, dtype=numpy.float32)
+        best_index = numpy.zeros((len(positions), 0), dtype=numpy.int64)
+        for start in range(0, len(vectors), block_size):
+            block = numpy.dot(query_vectors, vectors[start:start+block_size].T)
+            # exclude each query from its own neighbors
+            own = (positions >= start) & (positions < start + block_size)
+            block[own, positions[own] - start] = -numpy.inf
+            candidates = numpy.concatenate([best, block], axis=1)
+            candidate_index = numpy.concatenate(
+                    [best_index, numpy.broadcast_to(
+                            numpy.arange(start, start + block.shape[1]), block.shape)],
+                    axis=1)
+            if candidates.shape[1] > k:
+                top = numpy.argpartition(-candidates, k - 1, axis=1)[:, :k]
+                candidates, candidate_index = candidates[rows, top], candidate_index[rows, top]
+            best, best_index = candidates, candidate_index
+
+        order = numpy.argsort(-best, axis=1, kind='mergesort')
+        best, best_index = best[rows, order], best_index[rows, order]
+        # the row of each known query in best
+        row = numpy.cumsum(known) - 1
+        return [pandas.Series(best[row[i]], index=labels[best_index[row[i]]])
+                if known[i] else pandas.Series(dtype=best.dtype)
+                for i in range(len(known))]
+
+    def _load_specificity(self):
+        """
+        Load the tissue specificity rankings from tissue_specificity.h5,
+        or compute them from the tissue statistics if the file does not exist.
+
+        Args:
+            None
+
+        Returns:
+            dict
+
+        """
+        filename = os.path.join(gtexpath, 'tissue_specificity.h5')
+        if os.path.exists(filename):
+            with pandas.HDFStore(filename, 'r') as store:
+                genes = pandas.Index(store['genes'])
+                orders = {k: store['order/' + k] for k in self.__specificity__}
+        else:
+            mean = self.tissue_stats['mean']
+            genes = mean.index
+            scores = tissue_specificity(mean, self.tissue_stats['mean_clr'])
+            orders = {k: rank_tissue_specificity(scores[k])
+                      for k in self.__specificity__}
+        tissues = list(orders[self.__specificity__[0]].columns)
+        # keep the genes with an identifier, and number them among the kept genes
+        labels, keep = self._from_ensembl(genes)
+        position = numpy.cumsum(keep) - 1
+        return {'genes': labels[keep],
+                'tissues': tissues,
+                'keep': keep,
+                'position': position,
+                'order': {k: numpy.ascontiguousarray(orders[k][tissues].values.T)
+                          for k in orders},
+                'rank': {}}
+
+    def _specificity_order(self, score):
+        """
+        Get the specificity ordering of the genes with an identifier in
+        every tissue, as positions in the genes of the specificity index.
+        The orderings and the ranks of the genes are computed once for
+        each score.
+
+        Args:
+            score (str): one of Describer.__specificity__
+
+        Returns:
+            order (numpy array ~ (num_tissues, num_genes))
+            rank (numpy array ~ (num_tissues, num_genes))
+
+        """
+        assert score in self.__specificity__, \
+            "unknown score. known scores {}".format(self.__specificity__)
+        if self._specificity is None:
+            self._specificity = self._load_specificity()
+        specificity = self._specificity
+        if score not in specificity['rank']:
+            order = specificity['order'][score]
+            # every tissue orders all of the genes, so each row keeps the same number
+            kept = specificity['keep'][order]
+            order = specificity['position'][order[kept]].reshape(len(order), -1)
+            rank = numpy.empty_like(order)
+            rows = numpy.arange(order.shape[0])[:, None]
+            rank[rows, order] = numpy.arange(order.shape[1], dtype=order.dtype)
+            specificity['order'][score] = order
+            specificity['rank'][score] = rank
+        return specificity['order'][score], specificity['rank'][score]
+
+    def get_specific_genes(self, tissue, k=10, score='zscore'):
+        """
+        Get the genes that are most specifically expressed in a tissue.
+
+        Args:
+            tissue (str): the name of the GTEx tissue.
+            k (optional; int): the number of genes to return.
+            score (optional; str): one of Describer.__specificity__
+
+        Returns:
+            genes (List[str]): list of genes by the identifier.
+                Genes without an identifier are skipped.
+
+        """
+        order, _ = self._specificity_order(score)
+        t = self._specificity['tissues'].index(tissue)
+        return list(self._specificity['genes'][order[t, :k]])
+
+    def get_specificity_rank(self, gene_identifier, tissue, score='zscore'):
+        """
+        Get the rank of a gene among the genes expressed in a tissue,
+        where rank 0 is the most specific. Genes without an identifier
+        are not ranked, so the ranks match get_specific_genes.
+
+        Args:
+            gene_identifier (str): the identifier for the gene.
+            tissue (str): the name of the GTEx tissue.
+            score (optional; str): one of Describer.__specificity__
+
+        Returns:
+            int
+
+        """
+        _, rank = self._specificity_order(score)
+        genes = self._specificity['genes']
+        if gene_identifier not in genes:
+            raise KeyError("Unknown gene identifier {}".format(gene_identifier))
+        t = self._specificity['tissues'].index(tissue)
+        return int(rank[t, genes.get_loc(gene_identifier)])
+
     def close(self):
         """
-        Close the tissue stats HDF5 store if it is open.
+        Close the tissue stats HDF5 store if it is open, or wait for any
+        tables that are being preloaded.
 
         Args:
             None
@@ -75,7 +847,7 @@ class Describer(object):
         try:
             self.tissue_stats.close()
         except AttributeError:
-            pass
+            self.tissue_stats.wait()
 
     def get_tissue_expression(self, gene_identifier):
         """
@@ -96,6 +868,53 @@ class Describer(object):
         return pandas.concat({k: self.tissue_stats[k].loc[gene_id] for k in stats},
                               axis=1)
 
+    def get_tissue_expression_panel(self, gene_identifiers, stats=None,
+                                    as_frame=False):
+        """
+        Get statistics describing the expression of many genes across tissues
+        in healthy people (from GTEx).
+        Each statistic is gathered with a single take over the rows of its table.
+        Tissues are ordered as in Describer.tissues and statistics as in stats.
+        Rows for unknown genes are filled with NaN.
+
+        Args:
+            gene_identifiers (List[str]): the identifiers for the genes.
+            stats (optional; List[str]): the statistics to gather.
+                If None, all of the per-tissue statistics are used.
+            as_frame (optional; bool): if True, return a long-format DataFrame
+                indexed by (gene, tissue) with a column for each statistic.
+
+        Returns:
+            numpy array ~ (num_genes, num_tissues, num_stats)
+            or pandas.DataFrame ~ (num_genes * num_tissues, num_stats)
+
+        """
+        if stats is None:
+            stats = [s for s in self.__stats__ if s not in ['hellinger', 'hellinger_clr']]
+        gene_ids = self._to_ensembl(gene_identifiers)
+        tables = [self.tissue_stats[k] for k in stats]
+        index, tissues = tables[0].index, tables[0].columns
+        indexer = index.get_indexer(gene_ids)
+        dtype = numpy.result_type(*[t.values.dtype for t in tables])
+        # gather into a (stats, genes, tissues) buffer so that each take
+        # writes to contiguous memory, then return a transposed view
+        panel = numpy.empty((len(stats), len(gene_ids), len(tissues)), dtype=dtype)
+        for i, table in enumerate(tables):
+            positions = indexer
+            if not table.index.equals(index):
+                positions = table.index.get_indexer(gene_ids)
+            if not table.columns.equals(tissues):
+                table = table[tissues]
+            numpy.take(table.values, positions, axis=0, out=panel[i], mode='clip')
+            panel[i][positions < 0] = numpy.nan
+        panel = panel.transpose(1, 2, 0)
+        if as_frame:
+            index = pandas.MultiIndex.from_product(
+                    [list(gene_identifiers), list(tissues)], names=['gene', 'tissue'])
+            return pandas.DataFrame(panel.reshape(-1, len(stats)), index=index,
+                                    columns=stats)
+        return panel
+
     def plot_tissue_expression(self, gene_identifier, sortby=None, show=True,
                                filename=None):
         """
@@ -119,44 +938,81 @@ class Describer(object):
         else:
             stats = tissue_stats
 
+        boxes = tissue_boxplot_stats(stats[self.__boxplot_stats__].values)
+
         fig, ax = plt.subplots(figsize=(10, 4))
+        _draw_tissue_expression(ax, gene_identifier, list(stats.index), boxes)
 
-        n_box = len(stats)
-        boxes = ax.boxplot([[-9, -4, 2, 4, 9],]*n_box)
+        if show:
+            plt.show(fig)
+        if filename is not None:
+            fig.tight_layout()
+            fig.savefig(filename, bbox_inches='tight', dpi=300)
 
-        min_y, max_y = float('inf'), -float('inf')
+    def plot_tissue_expression_batch(self, gene_identifiers, directory=None,
+                                     filename=None, fmt='png', sortby=None,
+                                     n_jobs=1, dpi=300):
+        """
+        Plot the expression of many genes across tissues in healthy people
+        (from GTEx) without a display.
 
-        tissues = list(stats.index)
-        for i, tissue in enumerate(tissues):
-            mean = stats.loc[tissue]['mean']
-            med = stats.loc[tissue]['median']
-            std = stats.loc[tissue]['std']
-            lq = stats.loc[tissue]['lower_quartile']
-            uq = stats.loc[tissue]['upper_quartile']
+        The boxes and whiskers for all genes are computed at once.
+        Either one file per gene is written to a directory, with the
+        figures rendered by a pool of n_jobs processes, or all of the
+        figures are written as pages of a single PDF file.
+        Unknown genes are skipped with a warning.
 
-            lower_whisker = max(0, mean - 1.5 * std) # clamp at 0 expression
-            upper_whisker = mean + 1.5 * std
+        Args:
+            gene_identifiers (List[str]): the identifiers for the genes.
+            directory (optional; str): directory to write '<gene>.<fmt>' files.
+            filename (optional; str): path of a multipage PDF to write.
+            fmt (optional; str): file format for the per gene files,
+                e.g., 'png', 'svg' or 'pdf'.
+            sortby (optional; str): 'median', 'mean', 'std', 'lower_quartile'
+                or 'upper_quartile'. if None, then tissues are alphabetical
+            n_jobs (optional; int): number of processes for per gene files.
+            dpi (optional; int)
 
-            boxes['medians'][i].set_ydata([med, med])
-            boxes['caps'][2*i].set_ydata([lower_whisker, lower_whisker])
-            boxes['whiskers'][2*i].set_ydata([lower_whisker, lq])
-            boxes['caps'][2*i+1].set_ydata([upper_whisker, upper_whisker])
-            boxes['whiskers'][2*i + 1].set_ydata([uq, upper_whisker])
-            boxes['boxes'][i].set_ydata([lq, lq, uq, uq, lq])
+        Returns:
+            filenames (List[str]): the files that were written.
 
-            min_y = min(min_y, lower_whisker)
-            max_y = max(max_y, upper_whisker)
+        """
+        assert (directory is None) != (filename is None), \
+            "Must give exactly one of directory or filename"
+        gene_identifiers = list(gene_identifiers)
+        panel = self.get_tissue_expression_panel(gene_identifiers,
+                                                 stats=self.__boxplot_stats__)
+        known = ~numpy.isnan(panel).all(axis=(1, 2))
+        if not known.all():
+            warnings.warn("Could not find identifiers: {}".format(
+                    [g for g, k in zip(gene_identifiers, known) if not k]))
+        tissues = numpy.array(self.tissues)
+        boxes = tissue_boxplot_stats(panel)
+        if sortby is not None:
+            order = numpy.argsort(panel[:, :, self.__boxplot_stats__.index(sortby)],
+                                  axis=1, kind='mergesort')
+        else:
+            order = numpy.tile(numpy.arange(len(tissues)), (len(gene_identifiers), 1))
 
-        ax.set_ylim([min_y - 0.1 * min_y, max_y + 0.1 * max_y])
-        plt.xticks(numpy.arange(len(tissues)) + 1, tissues, rotation='vertical')
-        ax.set_title(gene_identifier)
-        ax.set_ylabel('TPM')
+        figures = [(gene, list(tissues[order[i]]), boxes[i][order[i]])
+                   for i, gene in enumerate(gene_identifiers) if known[i]]
 
-        if show:
-            plt.show(fig)
         if filename is not None:
-            fig.tight_layout()
-            fig.savefig(filename, bbox_inches='tight', dpi=300)
+            with PdfPages(filename) as pdf:
+                for title, gene_tissues, gene_boxes in figures:
+                    pdf.savefig(_tissue_expression_figure(title, gene_tissues, gene_boxes),
+                                bbox_inches='tight', dpi=dpi)
+            return [filename]
+
+        jobs = [(os.path.join(directory, '{}.{}'.format(title, fmt)),
+                 title, gene_tissues, gene_boxes, dpi)
+                for title, gene_tissues, gene_boxes in figures]
+        if n_jobs == 1:
+            return list(map(_save_tissue_expression, jobs))
+        with ProcessPoolExecutor(max_workers=n_jobs) as executor:
+            chunksize = max(1, len(jobs) // (4 * n_jobs))
+            return list(executor.map(_save_tissue_expression, jobs,
+                                     chunksize=chunksize))
 
     def _get_go_from_ensemble(self, ensembl):
         """
@@ -169,13 +1025,7 @@ class Describer(object):
             GO identifiers (List[str])
 
         """
-        terms = []
-        for term in self.searcher.go:
-            has_gene = any(ensembl in self.searcher.go[term]["genes"][code]
-                        for code in self.searcher.go[term]["genes"])
-            if has_gene:
-                terms += [term]
-        return list(set(terms))
+        return self.searcher.get_terms(ensembl)
 
     def get_gene_info(self, gene_identifier):
         """
@@ -199,3 +1049,39 @@ class Describer(object):
         gene_info['ontology'] = {i: self.searcher.go[i]['name']
             for i in self._get_go_from_ensemble(gene_info['ensembl'])}
         return gene_info
+
+    def get_gene_info_table(self, gene_identifiers):
+        """
+        Get some information about many genes such as:
+            ensemble_gene_id
+            gene symbol
+            name
+            associated categories in each namespace of the Gene Ontology
+
+        Args:
+            gene_identifiers (List[str]): the identifiers for the genes.
+
+        Returns:
+            pandas.DataFrame ~ (num_genes, 6)
+
+        """
+        gene_info = pandas.DataFrame(index=list(gene_identifiers))
+        gene_info['ensembl'] = self._to_ensembl(gene_identifiers)
+        ensembl = list(gene_info['ensembl'])
+        gene_info['symbol'] = self._converter(
+                'ensembl_gene_id', 'symbol').convert_list(ensembl)
+        gene_info['name'] = self._converter(
+                'ensembl_gene_id', 'name').convert_list(ensembl)
+        namespaces = ['biological_process', 'molecular_function', 'cellular_component']
+        terms = {n: [] for n in namespaces}
+        for gene in ensembl:
+            by_namespace = {n: [] for n in namespaces}
+            for term in self.searcher.get_terms(gene):
+                namespace = self.searcher.go[term]['namespace']
+                if namespace in by_namespace:
+                    by_namespace[namespace].append(term)
+            for n in namespaces:
+                terms[n].append(sorted(by_namespace[n]))
+        for n in namespaces:
+            gene_info[n] = terms[n]
+        return gene_info
@@ -1,14 +1,27 @@
 import os
+import hashlib
+import inspect
 import pandas
 import numpy
 import pickle
+import scipy.sparse
+import time
 import warnings
 from pathlib import Path
-from cytoolz import partial
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from scipy.special import erfc
+from scipy.stats import rankdata, t as t_distribution
 
 from . import convert
 from . import describe
 
+GENE_INFO = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                         'data', 'gtex', 'gene_info.csv')
+
+# gene lengths that have been loaded in this process, by identifier
+_gene_lengths = {}
+
 def do_nothing(data):
     """
     A function that does nothing.
@@ -23,117 +36,1211 @@ def do_nothing(data):
     return data
 
 
-def deduplicate(data):
+def deduplicate(data, how='sum'):
     """
     Adds the values from any duplicated genes.
 
+    The column labels are factorized once, and the columns of each gene are
+    gathered next to each other and reduced with numpy.add.reduceat (or
+    numpy.fmax.reduceat). Missing values are skipped. The genes keep the
+    order of their first appearance, and data with unique columns are
+    returned unchanged.
+
+    The 'sum' and 'max' keep the type of integer or float data (float
+    values are accumulated in float64), while the 'mean' and data with
+    mixed types give float64.
+
     Args:
         data (pandas.DataFrame ~ (num_samples, num_genes))
+        how (optional; str): 'sum', 'mean' or 'max' of the duplicates.
+
+    Returns:
+        pandas.DataFrame
+
+    """
+    assert how in ['sum', 'mean', 'max'], "how must be 'sum', 'mean' or 'max'"
+    if data.columns.is_unique:
+        return data
+    codes, genes = pandas.factorize(data.columns)
+    order = numpy.argsort(codes, kind='stable')
+    starts = numpy.flatnonzero(numpy.diff(codes[order], prepend=-1))
+    values = data.values[:, order]
+    dtype = values.dtype
+    if how != 'mean' and numpy.issubdtype(dtype, numpy.integer):
+        # integers have no missing values and add up exactly
+        reduce = numpy.maximum if how == 'max' else numpy.add
+        result = reduce.reduceat(values, starts, axis=1)
+        return pandas.DataFrame(result, index=data.index, columns=genes)
+    values = numpy.asarray(values, dtype=numpy.float64)
+    if how == 'max':
+        result = numpy.fmax.reduceat(values, starts, axis=1)
+    else:
+        missing = numpy.isnan(values)
+        if how == 'mean':
+            counts = numpy.add.reduceat(~missing, starts, axis=1)
+        numpy.copyto(values, 0, where=missing)
+        result = numpy.add.reduceat(values, starts, axis=1)
+        if how == 'mean':
+            with numpy.errstate(divide='ignore', invalid='ignore'):
+                result /= counts
+    if how != 'mean' and numpy.issubdtype(dtype, numpy.floating):
+        result = result.astype(dtype, copy=False)
+    return pandas.DataFrame(result, index=data.index, columns=genes)
+
+
+def _imputer_buffer(data, inplace):
+    """
+    Get a float buffer of the data for an imputer to modify.
+
+    Args:
+        data (pandas.DataFrame or numpy array ~ (num_samples, num_genes))
+        inplace (bool): reuse the buffer of the data if it is writable floats.
+
+    Returns:
+        numpy array ~ (num_samples, num_genes)
+
+    """
+    values = data.values if isinstance(data, pandas.DataFrame) else numpy.asarray(data)
+    if not inplace or values.dtype.kind != 'f' or not values.flags.writeable:
+        values = numpy.array(values, dtype=numpy.result_type(values.dtype, numpy.float32))
+    return values
+
+
+def _imputer_result(data, values):
+    """
+    Return imputed values with the same type as the input of an imputer.
+
+    Args:
+        data (pandas.DataFrame or numpy array ~ (num_samples, num_genes))
+        values (numpy array ~ (num_samples, num_genes))
+
+    Returns:
+        pandas.DataFrame or numpy array ~ (num_samples, num_genes)
+
+    """
+    if isinstance(data, pandas.DataFrame):
+        return pandas.DataFrame(values, index=data.index, columns=data.columns)
+    return values
+
+
+def _row_minimum(values):
+    """
+    Get the smallest positive value in each row, or NaN for rows without
+    any positive values.
+
+    Args:
+        values (numpy array ~ (num_samples, num_genes))
+
+    Returns:
+        numpy array ~ (num_samples,)
+
+    """
+    minimum = numpy.min(values, axis=1, where=values > 0, initial=numpy.inf)
+    minimum[numpy.isinf(minimum)] = numpy.nan
+    return minimum
+
+
+def impute(data, scale=0.5, inplace=False):
+    """
+    Replace any zeros in each row with a fraction of the smallest non-zero
+    value in the corresponding row.
+
+    Args:
+        data (pandas.DataFrame or numpy array ~ (num_samples, num_genes))
+        scale (optional; float)
+        inplace (optional; bool): overwrite the data if it is a float buffer.
+
+    Returns:
+        imputed data (pandas.DataFrame or numpy array ~ (num_samples, num_genes))
+
+    """
+    values = _imputer_buffer(data, inplace)
+    numpy.copyto(values, 0, where=numpy.isnan(values))
+    fill = scale * _row_minimum(values)
+    numpy.copyto(values, fill[:, None], where=values == 0)
+    # rows without any positive values cannot be imputed
+    values[numpy.isnan(fill)] = numpy.nan
+    return _imputer_result(data, values)
+
+
+def multiplicative_replacement(data, delta=None, inplace=False):
+    """
+    Replace any zeros in each row with a small fraction (delta) of the row
+    total, and shrink the non-zero values so that the row total is unchanged.
+    This is the multiplicative replacement of Martin-Fernandez et al. (2003).
+
+    Args:
+        data (pandas.DataFrame or numpy array ~ (num_samples, num_genes))
+        delta (optional; float): the fraction of the row total used to replace
+            each zero. Default: 1 / num_genes**2.
+        inplace (optional; bool): overwrite the data if it is a float buffer.
+
+    Returns:
+        imputed data (pandas.DataFrame or numpy array ~ (num_samples, num_genes))
+
+    """
+    values = _imputer_buffer(data, inplace)
+    numpy.copyto(values, 0, where=numpy.isnan(values))
+    if delta is None:
+        delta = 1 / values.shape[1]**2
+    zeros = values == 0
+    num_zeros = zeros.sum(axis=1)
+    total = values.sum(axis=1)
+    values *= (1 - delta * num_zeros)[:, None]
+    numpy.copyto(values, (delta * total)[:, None], where=zeros)
+    return _imputer_result(data, values)
+
+
+def pseudocount(data, value=1, inplace=False):
+    """
+    Add a constant to every value, after setting any missing values to zero.
+
+    Args:
+        data (pandas.DataFrame or numpy array ~ (num_samples, num_genes))
+        value (optional; float)
+        inplace (optional; bool): overwrite the data if it is a float buffer.
+
+    Returns:
+        imputed data (pandas.DataFrame or numpy array ~ (num_samples, num_genes))
+
+    """
+    values = _imputer_buffer(data, inplace)
+    numpy.copyto(values, 0, where=numpy.isnan(values))
+    values += value
+    return _imputer_result(data, values)
+
+
+class DetectionImputer(object):
+    """
+    Replace any zeros with a fraction of the smallest non-zero value in the
+    row, scaled by how often the gene is detected in a GTEx tissue, so that
+    genes that are rarely expressed in the tissue get smaller values.
+
+    Attributes:
+        tissue (str): the GTEx tissue
+        scale (float): the fraction of the smallest non-zero value
+        min_detection (float): the smallest detection rate used for scaling
+
+    """
+    def __init__(self, tissue, identifier='symbol', scale=0.5, min_detection=0.01):
+        """
+        Replace zeros using the detection rate of genes in a GTEx tissue.
+
+        Args:
+            tissue (str): a GTEx tissue
+            identifier (optional; str): the gene identifier of the data
+            scale (optional; float): the fraction of the smallest non-zero value
+            min_detection (optional; float): the smallest detection rate used
+                for scaling, so that no gene is imputed with zero.
+
+        Returns:
+            DetectionImputer
+
+        """
+        self.tissue = tissue
+        self.scale = scale
+        self.min_detection = min_detection
+        self.describer = describe.Describer(identifier)
+        self._detection = None
+
+    def detection(self, genes):
+        """
+        Get the fraction of GTEx samples of the tissue that express each gene.
+        Genes that are not in GTEx are treated as always detected.
+
+        Args:
+            genes (pandas.Index)
+
+        Returns:
+            numpy array ~ (num_genes,)
+
+        """
+        if self._detection is None or not _same_labels(self._detection[0], genes):
+            fraction_zero = self.describer.get_reference('fraction_zero', genes)
+            detection = 1 - fraction_zero[self.tissue].values.astype(numpy.float64)
+            detection = numpy.clip(numpy.nan_to_num(detection, nan=1.0),
+                                   self.min_detection, 1)
+            self._detection = (pandas.Index(genes), detection)
+        return self._detection[1]
+
+    def __call__(self, data, inplace=False):
+        """
+        Impute the zeros of the data.
+
+        Args:
+            data (pandas.DataFrame ~ (num_samples, num_genes))
+            inplace (optional; bool): overwrite the data if it is a float buffer.
+
+        Returns:
+            imputed data (pandas.DataFrame ~ (num_samples, num_genes))
+
+        """
+        assert isinstance(data, pandas.DataFrame), "data must have gene columns"
+        values = _imputer_buffer(data, inplace)
+        numpy.copyto(values, 0, where=numpy.isnan(values))
+        zeros = values == 0
+        fill = self.scale * _row_minimum(values)
+        numpy.copyto(values, fill[:, None] * self.detection(data.columns), where=zeros)
+        values[numpy.isnan(fill)] = numpy.nan
+        return _imputer_result(data, values)
+
+
+def benjamini_hochberg(pvalues):
+    """
+    Compute Benjamini-Hochberg adjusted p-values (q-values) along the last
+    axis, e.g., separately for each sample of a (num_samples, num_genes) array.
+    NaN p-values are not counted as tests and have NaN q-values.
+
+    Args:
+        pvalues (numpy array ~ (..., num_tests))
+
+    Returns:
+        qvalues (numpy array ~ (..., num_tests))
+
+    """
+    pvalues = numpy.asarray(pvalues, dtype=numpy.float64)
+    num_tests = (~numpy.isnan(pvalues)).sum(axis=-1, keepdims=True)
+    # NaN sorts last, so the finite p-values come first in each row
+    order = numpy.argsort(pvalues, axis=-1)
+    qvalues = numpy.take_along_axis(pvalues, order, axis=-1)
+    qvalues *= num_tests / numpy.arange(1, pvalues.shape[-1] + 1)
+    missing = numpy.isnan(qvalues)
+    qvalues[missing] = numpy.inf
+    qvalues = numpy.minimum.accumulate(qvalues[..., ::-1], axis=-1)[..., ::-1]
+    qvalues = numpy.minimum(qvalues, 1)
+    qvalues[missing] = numpy.nan
+    adjusted = numpy.empty_like(qvalues)
+    numpy.put_along_axis(adjusted, order, qvalues, axis=-1)
+    return adjusted
+
+
+def differential_expression(data, groups, contrasts=None, test='welch',
+                            chunk_size=2000):
+    """
+    Test for differences in the expression of each gene between groups of
+    samples, e.g., on CLR data.
+
+    Genes are processed in chunks of columns. For the Welch t-test the group
+    means and the centered sums of squares of a chunk are computed for all
+    groups at once with two matrix products. For the Mann-Whitney U test, genes are ranked within
+    the samples of each contrast and a normal approximation with tie and
+    continuity corrections is used. P-values are adjusted across genes with the
+    Benjamini-Hochberg procedure separately for each contrast.
+
+    Args:
+        data (pandas.DataFrame ~ (num_samples, num_genes)): CLR data
+        groups (pandas.Series ~ (num_samples,)): group labels of the samples
+        contrasts (optional; List[tuple]): pairs of group labels (a, b) to
+            compare. If None, all pairs of groups are compared.
+        test (optional; str): 'welch' or 'mannwhitney'
+        chunk_size (optional; int): the number of genes per chunk.
+
+    Returns:
+        dict{tuple: pandas.DataFrame ~ (num_genes, 4)}: for each contrast,
+            columns 'mean_difference' (a - b), 'statistic', 'p_value' and 'q_value'.
+
+    """
+    assert test in ['welch', 'mannwhitney'], "test must be 'welch' or 'mannwhitney'"
+    labels = groups.reindex(data.index)
+    names = sorted(labels.dropna().unique())
+    if contrasts is None:
+        contrasts = [(a, b) for i, a in enumerate(names) for b in names[i+1:]]
+    membership = numpy.array([(labels == g).values for g in names], dtype=numpy.float64)
+    counts = membership.sum(axis=1)
+    # the group of each sample, for samples in any group
+    grouped = membership.any(axis=0)
+    codes = membership[:, grouped].argmax(axis=0)
+    position = {g: i for i, g in enumerate(names)}
+    for a, b in contrasts:
+        assert counts[position[a]] > 1 and counts[position[b]] > 1, \
+            "Each group in a contrast must have at least 2 samples"
+
+    num_genes = data.shape[1]
+    results = {c: numpy.empty((num_genes, 3)) for c in contrasts}
+    values = data.values
+    for start in range(0, num_genes, chunk_size):
+        x = numpy.asarray(values[:, start:start+chunk_size], dtype=numpy.float64)
+        means = numpy.dot(membership, x) / counts[:, None]
+        deviations = x[grouped] - means[codes]
+        variances = numpy.dot(membership[:, grouped], deviations**2) \
+                    / (counts[:, None] - 1)
+        variances = numpy.maximum(variances, 0)
+        for a, b in contrasts:
+            i, j = position[a], position[b]
+            n_a, n_b = counts[i], counts[j]
+            difference = means[i] - means[j]
+            if test == 'welch':
+                se_a, se_b = variances[i] / n_a, variances[j] / n_b
+                se = se_a + se_b
+                statistic = difference / numpy.sqrt(se)
+                df = se**2 / (se_a**2 / (n_a - 1) + se_b**2 / (n_b - 1))
+                pvalue = 2 * t_distribution.sf(numpy.abs(statistic), df)
+            else:
+                in_a = membership[i].astype(bool)
+                in_subset = in_a | membership[j].astype(bool)
+                subset = x[in_subset]
+                ranks = rankdata(subset, axis=0)
+                # the size of the tie group of each value from its average
+                # and minimum ranks
+                ties = 2 * (ranks - rankdata(subset, method='min', axis=0)) + 1
+                n = n_a + n_b
+                statistic = ranks[in_a[in_subset]].sum(axis=0) - n_a * (n_a + 1) / 2
+                tie_term = (ties**2 - 1).sum(axis=0) / (n * (n - 1))
+                sigma = numpy.sqrt(n_a * n_b / 12 * ((n + 1) - tie_term))
+                deviation = numpy.maximum(numpy.abs(statistic - n_a * n_b / 2) - 0.5, 0)
+                z = numpy.divide(deviation, sigma, out=numpy.zeros_like(deviation),
+                                 where=sigma > 0)
+                pvalue = numpy.minimum(erfc(z / numpy.sqrt(2)), 1)
+            results[(a, b)][start:start+chunk_size] = \
+                numpy.stack([difference, statistic, pvalue], axis=1)
+
+    tables = {}
+    for c in contrasts:
+        table = pandas.DataFrame(results[c], index=data.columns,
+                                 columns=['mean_difference', 'statistic', 'p_value'])
+        table['q_value'] = benjamini_hochberg(table['p_value'].values)
+        tables[c] = table
+    return tables
+
+
+def percentile_ranks(data, quantiles):
+    """
+    Estimate the percentile of each value within the distribution of its gene,
+    given evenly spaced quantiles of the distribution of every gene.
+    Percentiles are linearly interpolated between neighboring quantiles.
+    Genes with missing quantiles are NaN.
+
+    Each row of quantiles is mapped to [2 g, 2 g + 1] for gene g, which
+    makes the concatenated quantiles of all genes a single sorted array,
+    so that one call to numpy.searchsorted handles the whole matrix.
+
+    Args:
+        data (numpy array ~ (num_samples, num_genes))
+        quantiles (numpy array ~ (num_genes, num_quantiles)): sorted along
+            the quantile axis.
+
+    Returns:
+        percentiles (numpy array ~ (num_samples, num_genes)): in [0, 100]
+
+    """
+    quantiles = numpy.array(quantiles, dtype=numpy.float64)
+    num_genes, num_quantiles = quantiles.shape
+    missing = numpy.isnan(quantiles).any(axis=1)
+    quantiles[missing] = 0
+    low = quantiles[:, 0]
+    span = quantiles[:, -1] - low
+    span[~(span > 0)] = 1
+    offsets = 2 * numpy.arange(num_genes)
+    keys = ((quantiles - low[:, None]) / span[:, None] + offsets[:, None]).ravel()
+    scaled = numpy.clip((data - low) / span, 0, 1) + offsets
+    # the number of quantiles of each gene that are <= each value
+    position = numpy.searchsorted(keys, scaled, side='right') - num_quantiles * offsets // 2
+    below = numpy.clip(position - 1, 0, num_quantiles - 2)
+    flat = quantiles.ravel()
+    lower = flat[num_quantiles * numpy.arange(num_genes) + below]
+    upper = flat[num_quantiles * numpy.arange(num_genes) + below + 1]
+    fraction = numpy.divide(data - lower, upper - lower,
+                            out=numpy.zeros_like(lower), where=upper > lower)
+    percentiles = 100 * (below + numpy.clip(fraction, 0, 1)) / (num_quantiles - 1)
+    percentiles[position == 0] = 0
+    percentiles[position == num_quantiles] = 100
+    percentiles[numpy.isnan(data)] = numpy.nan
+    percentiles[:, missing] = numpy.nan
+    return percentiles
+
+
+def _map_row_blocks(function, num_rows, n_jobs=1):
+    """
+    Apply a function to contiguous blocks of rows.
+
+    The function is called as function(start, stop) and should modify a
+    buffer in place. When n_jobs > 1 the rows are split into n_jobs blocks
+    that are processed by a pool of threads; the numpy kernels release the
+    GIL, so the blocks run concurrently.
+
+    Args:
+        function (callable): function(start, stop)
+        num_rows (int): the number of rows
+        n_jobs (optional; int): the number of threads.
+
+    Returns:
+        None
+
+    """
+    if n_jobs == 1 or num_rows <= 1:
+        function(0, num_rows)
+        return
+    bounds = numpy.linspace(0, num_rows, min(n_jobs, num_rows) + 1).astype(int)
+    with ThreadPoolExecutor(max_workers=n_jobs) as executor:
+        # list forces any exceptions raised in the threads
+        list(executor.map(function, bounds[:-1], bounds[1:]))
+
+
+def _z_score_by_tissue(values, codes, mean, std):
+    """
+    Convert a float buffer to z-scores in place, grouping the rows by tissue
+    so that the (num_tissues, num_genes) reference arrays are broadcast
+    instead of expanded to one row per sample.
+
+    Args:
+        values (numpy array ~ (num_samples, num_genes))
+        codes (numpy array ~ (num_samples,)): the tissue of each row,
+            as a row index into mean and std
+        mean (numpy array ~ (num_tissues, num_genes))
+        std (numpy array ~ (num_tissues, num_genes))
+
+    Returns:
+        values (numpy array ~ (num_samples, num_genes))
+
+    """
+    for code in numpy.unique(codes):
+        rows = numpy.flatnonzero(codes == code)
+        if len(rows) == len(values):
+            values -= mean[code]
+            values /= std[code]
+        else:
+            values[rows] = (values[rows] - mean[code]) / std[code]
+    return values
+
+
+def _accepts_inplace(imputer):
+    """
+    Check whether an imputer takes an inplace argument.
+
+    Args:
+        imputer (callable)
+
+    Returns:
+        bool
+
+    """
+    try:
+        return 'inplace' in inspect.signature(imputer).parameters
+    except (TypeError, ValueError):
+        return False
+
+
+def _label_key(labels):
+    """
+    Get a cheap key for a sequence of labels, such as the columns of a
+    DataFrame: the number of labels and the first and last labels.
+    Different labels can share a key, so a match must be confirmed with
+    _same_labels.
+
+    Args:
+        labels (List[str] or None)
+
+    Returns:
+        tuple or None
+
+    """
+    if labels is None:
+        return None
+    if len(labels) == 0:
+        return (0,)
+    return (len(labels), labels[0], labels[len(labels) - 1])
+
+
+def _same_labels(index, labels):
+    """
+    Check whether stored labels are the same as the given labels.
+    The same object is matched without comparing the labels.
+
+    Args:
+        index (pandas.Index or None): the stored labels
+        labels (List[str] or None)
+
+    Returns:
+        bool
+
+    """
+    if index is None or labels is None or index is labels:
+        return index is labels
+    return index.equals(pandas.Index(labels))
+
+
+def cache_directory():
+    """
+    The directory of the on-disk cache: $GENEMUNGE_CACHE if it is set,
+    or ~/.cache/genemunge.
+
+    Args:
+        None
+
+    Returns:
+        str
+
+    """
+    return os.environ.get('GENEMUNGE_CACHE',
+                          os.path.join(os.path.expanduser('~'), '.cache', 'genemunge'))
+
+
+def _fingerprint(filenames):
+    """
+    Hash the path, size and modification time of some files.
+
+    Args:
+        filenames (List[str])
+
+    Returns:
+        str: a sha1 digest
+
+    """
+    digest = hashlib.sha1()
+    for filename in filenames:
+        info = os.stat(filename)
+        digest.update('{}:{}:{};'.format(
+                os.path.abspath(filename), info.st_size, info.st_mtime_ns).encode())
+    return digest.hexdigest()
+
+
+def _read_gene_lengths(identifier):
+    """
+    Read the bp lengths of the GTEx genes, indexed by the identifier.
+
+    Args:
+        identifier (str)
+
+    Returns:
+        pandas.Series
+
+    """
+    gene_info = pandas.read_csv(GENE_INFO, sep='\t')
+    gene_info.set_index('gene_id', inplace=True)
+    gene_lengths = gene_info['bp_length']
+    # clean the ensemble gene ids
+    gene_lengths.index = convert.clean_ensembl_ids(gene_lengths.index)
+    gene_lengths = gene_lengths[~gene_lengths.index.duplicated(keep='first')]
+    # convert the gene ids
+    if identifier != 'ensembl_gene_id':
+        converter = convert.IDConverter('ensembl_gene_id', identifier)
+        gene_lengths.index = converter.convert_list(list(gene_lengths.index))
+    # drop any NaN and duplicate ids
+    gene_lengths = gene_lengths[~gene_lengths.index.isnull()]
+    return gene_lengths[~gene_lengths.index.duplicated(keep='first')]
+
+
+def _load_gene_lengths(identifier):
+    """
+    Get the bp lengths of the GTEx genes, indexed by the identifier.
+
+    The lengths are cached in memory and in the cache_directory, keyed by the
+    identifier and a fingerprint of the data files, so that they are read,
+    converted and deduplicated only once. The cached lengths are memory-mapped.
+
+    Args:
+        identifier (str)
+
+    Returns:
+        pandas.Series
+
+    """
+    filenames = [GENE_INFO]
+    if identifier != 'ensembl_gene_id':
+        filenames.append(convert.FILENAME)
+    key = (identifier, _fingerprint(filenames))
+    if key not in _gene_lengths:
+        base = os.path.join(cache_directory(),
+                            'gene_lengths_{}_{}'.format(identifier, key[1]))
+        try:
+            genes = numpy.load(base + '_genes.npy')
+            lengths = numpy.load(base + '_lengths.npy', mmap_mode='r')
+            gene_lengths = pandas.Series(lengths, index=pandas.Index(genes, dtype=object),
+                                         name='bp_length')
+        except (OSError, ValueError):
+            gene_lengths = _read_gene_lengths(identifier)
+            _save_gene_lengths(base, gene_lengths)
+        _gene_lengths[key] = gene_lengths
+    return _gene_lengths[key].copy(deep=False)
+
+
+def _save_gene_lengths(base, gene_lengths):
+    """
+    Write gene lengths to the cache, if the identifiers are strings and
+    the cache directory is writable.
+
+    Args:
+        base (str): the path of the cache files, without suffixes
+        gene_lengths (pandas.Series)
+
+    Returns:
+        None
+
+    """
+    if gene_lengths.index.inferred_type != 'string':
+        return
+    try:
+        os.makedirs(os.path.dirname(base), exist_ok=True)
+        # write to temporary files first so that other processes never
+        # read a partial file
+        suffix = '.{}.tmp.npy'.format(os.getpid())
+        for name, values in [('_genes', numpy.asarray(gene_lengths.index, dtype=str)),
+                             ('_lengths', numpy.asarray(gene_lengths.values))]:
+            numpy.save(base + name + suffix, values)
+        # the lengths are renamed last, since they mark a complete entry
+        os.replace(base + '_genes' + suffix, base + '_genes.npy')
+        os.replace(base + '_lengths' + suffix, base + '_lengths.npy')
+    except OSError:
+        pass
+
+
+def _file_format(filename):
+    """
+    Get the format of an expression data file from its extension.
+
+    Args:
+        filename (str)
+
+    Returns:
+        str: 'csv', 'tsv', 'hdf' or 'parquet'
+
+    """
+    extension = os.path.splitext(filename)[1].lower()
+    formats = {'.csv': 'csv', '.tsv': 'tsv', '.txt': 'tsv', '.h5': 'hdf',
+               '.hdf': 'hdf', '.hdf5': 'hdf', '.parquet': 'parquet', '.pq': 'parquet'}
+    assert extension in formats, \
+        "unknown file extension. known extensions {}".format(list(formats))
+    return formats[extension]
+
+
+def _import_parquet():
+    """
+    Import pyarrow, which is only needed for parquet files.
+
+    Args:
+        None
+
+    Returns:
+        module: pyarrow, with pyarrow.parquet imported
+
+    """
+    try:
+        import pyarrow
+        import pyarrow.parquet
+    except ImportError:
+        raise ImportError("reading or writing parquet files requires pyarrow")
+    return pyarrow
+
+
+def read_chunks(filename, chunk_size=1000, key='data'):
+    """
+    Read an expression data file (num_samples, num_genes) in chunks of samples.
+
+    CSV and TSV files must have the sample ids in the first column.
+    HDF5 files are read from the given key, either a single frame or a
+    sequence of frames at '<key>/chunk_<i>' as written by write_chunks.
+    Parquet files are read in record batches and require pyarrow.
+
+    Args:
+        filename (str)
+        chunk_size (optional; int): the number of samples per chunk.
+        key (optional; str): the key of the data in an HDF5 file.
+
+    Returns:
+        iterator of pandas.DataFrame ~ (chunk_size, num_genes)
+
+    """
+    file_format = _file_format(filename)
+    if file_format in ['csv', 'tsv']:
+        sep = ',' if file_format == 'csv' else '\t'
+        for chunk in pandas.read_csv(filename, sep=sep, index_col=0,
+                                     chunksize=chunk_size):
+            yield chunk
+    elif file_format == 'hdf':
+        with pandas.HDFStore(filename, 'r') as store:
+            if '/' + key in store.keys():
+                storer = store.get_storer(key)
+                # the shape of a table is its number of rows
+                num_rows = storer.nrows if storer.is_table else storer.shape[0]
+                for start in range(0, num_rows, chunk_size):
+                    yield store.select(key, start=start, stop=start+chunk_size)
+            else:
+                parts = sorted(k for k in store.keys()
+                               if k.startswith('/{}/chunk_'.format(key)))
+                for part in parts:
+                    yield store[part]
+    else:
+        pyarrow = _import_parquet()
+        for batch in pyarrow.parquet.ParquetFile(filename).iter_batches(
+                batch_size=chunk_size):
+            yield batch.to_pandas()
+
+
+class ChunkWriter(object):
+    """
+    Write an expression data file (num_samples, num_genes) in chunks of samples.
+
+    CSV and TSV chunks are appended to the file. HDF5 chunks are stored in
+    fixed format at '<key>/chunk_<i>', because table format cannot hold tens
+    of thousands of columns. Parquet chunks are written as row groups and
+    require pyarrow.
+
+    Attributes:
+        filename (str)
+        key (str): the key of the data in an HDF5 file.
+
+    """
+    def __init__(self, filename, key='data'):
+        """
+        Create a writer for an expression data file.
+        Any existing file is overwritten.
+
+        Args:
+            filename (str)
+            key (optional; str): the key of the data in an HDF5 file.
+
+        Returns:
+            ChunkWriter
+
+        """
+        self.filename = filename
+        self.key = key
+        self._format = _file_format(filename)
+        self._count = 0
+        self._writer = None
+        if self._format == 'hdf':
+            self._writer = pandas.HDFStore(filename, 'w')
+
+    def write(self, chunk):
+        """
+        Write a chunk of samples.
+
+        Args:
+            chunk (pandas.DataFrame ~ (chunk_size, num_genes))
+
+        Returns:
+            None
+
+        """
+        if self._format in ['csv', 'tsv']:
+            sep = ',' if self._format == 'csv' else '\t'
+            chunk.to_csv(self.filename, sep=sep, mode='w' if self._count == 0 else 'a',
+                         header=self._count == 0)
+        elif self._format == 'hdf':
+            self._writer.put('{}/chunk_{:06d}'.format(self.key, self._count), chunk)
+        else:
+            pyarrow = _import_parquet()
+            table = pyarrow.Table.from_pandas(chunk)
+            if self._writer is None:
+                self._writer = pyarrow.parquet.ParquetWriter(self.filename, table.schema)
+            self._writer.write_table(table)
+        self._count += 1
+
+    def close(self):
+        """
+        Close the file.
+
+        Args:
+            None
+
+        Returns:
+            None
+
+        """
+        if self._writer is not None:
+            self._writer.close()
+            self._writer = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+class Normalizer(object):
+    """
+    Tools to change units of expression data, primarily to convert to TPM.
+
+    Attributes:
+        gene_lengths (DataFrame): bp lengths for genes, cached per identifier.
+        converter (IDConverter): from Ensembl ids, created on first use.
+        describer (Describer): statistics from GTEx, created on first use.
+        plan_cache_size (int): the number of reindex plans to keep.
+        dtype (numpy dtype): the float type of the outputs.
+
+    """
+    def __init__(self, identifier='symbol', plan_cache_size=32, dtype=numpy.float64):
+        """
+        Tools to normalize expression data and transform into TPM.
+
+        Args:
+            identifier (str)
+            plan_cache_size (optional; int): the number of reindex plans, one
+                per layout of columns and gene list, to keep in memory.
+            dtype (optional; numpy dtype): the float type of the outputs,
+                numpy.float64 or numpy.float32. Row sums and means are
+                accumulated in float64 either way. Each transform also takes
+                a dtype argument to override this.
+
+        Returns:
+            Normalizer
+
+        """
+        self.gene_lengths = _load_gene_lengths(identifier)
+        self._converter = None
+        self.identifier = identifier
+        self._describer = None
+        self.plan_cache_size = plan_cache_size
+        self._plans = OrderedDict()
+        self.dtype = numpy.dtype(dtype)
+
+    @property
+    def converter(self):
+        if self._converter is None and self.identifier != 'ensembl_gene_id':
+            self._converter = convert.IDConverter('ensembl_gene_id', self.identifier)
+        return self._converter
+
+    @property
+    def describer(self):
+        if self._describer is None:
+            self._describer = describe.Describer(self.identifier)
+        return self._describer
+
+    def _match_genes(self, gene_list):
+        """
+        Split a list of identifiers into those that occur in GTEx and,
+        therefore, have gene lengths, and those that do not.
+
+        Args:
+            gene_list (List[str])
+
+        Returns:
+            common_genes (List[str]), missing_genes (List[str])
+
+        """
+        if gene_list is None:
+            # reindex to all of the gtex genes
+            return list(self.gene_lengths.index), []
+        # select the genes in the gene_list that also occur in gtex
+        genes = pandas.Index(gene_list)
+        present = genes.isin(self.gene_lengths.index)
+        common_genes = list(genes[present])
+        missing_genes = list(set(genes[~present]))
+        return common_genes, missing_genes
+
+    def _get_common_genes(self, gene_list):
+        """
+        Get a set of identifiers that occur in GTEx and, therefore,
+        have gene lengths.
+
+        Args:
+            gene_list (List[str])
+
+        Returns:
+            common_genes (List[str])
+
+        """
+        common_genes, missing_genes = self._match_genes(gene_list)
+        # warn the user about any genes that are not in gtex and are being dropped
+        if len(missing_genes) > 0:
+            warnings.warn("Could not find identifiers: {}".format(missing_genes))
+        return common_genes
+
+    def _reindex_plan(self, columns, gene_list):
+        """
+        Compute the integer positions needed to reindex data with the given
+        columns to the genes that occur in GTEx.
+
+        Plans are cached on the length and the first and last labels of the
+        columns and the gene list, and a cached plan is used only if the
+        labels are equal (or are the same objects). The plan_cache_size most
+        recently used plans are kept, so that repeated batches with the same
+        layout skip all of the label lookups.
+
+        Args:
+            columns (pandas.Index): the columns of the data
+            gene_list (List[str]): a list of gene ids
+
+        Returns:
+            common_genes (pandas.Index),
+            indexer (numpy array): the position of each common gene in columns,
+                or -1 if it is missing.
+            lengths (numpy array): the lengths of the common genes.
+
+        """
+        key = (_label_key(columns), _label_key(gene_list))
+        cached = self._plans.get(key)
+        if (cached is not None and _same_labels(cached[0], columns)
+                and _same_labels(cached[1], gene_list)):
+            self._plans.move_to_end(key)
+            common_genes, indexer, lengths, warning = cached[2:]
+        else:
+            common_genes, missing_genes = self._match_genes(gene_list)
+            common_genes = pandas.Index(common_genes)
+            indexer = columns.get_indexer(common_genes)
+            lengths = self.gene_lengths.values[
+                self.gene_lengths.index.get_indexer(common_genes)]
+            indexer.setflags(write=False)
+            lengths.setflags(write=False)
+            warning = None
+            if len(missing_genes) > 0:
+                warning = "Could not find identifiers: {}".format(missing_genes)
+            if self.plan_cache_size > 0:
+                stored_genes = gene_list
+                if gene_list is not None and not isinstance(gene_list, pandas.Index):
+                    stored_genes = pandas.Index(gene_list)
+                self._plans[key] = (columns, stored_genes, common_genes, indexer,
+                                    lengths, warning)
+                self._plans.move_to_end(key)
+                while len(self._plans) > self.plan_cache_size:
+                    self._plans.popitem(last=False)
+        # warn the user about any genes that are not in gtex and are being dropped
+        if warning is not None:
+            warnings.warn(warning)
+        return common_genes, indexer, lengths
+
+    def _reindex_values(self, data, gene_list=None, out=None, block_size=1024,
+                        n_jobs=1, dtype=None, keep_dtype=False):
+        """
+        Copy the data into a single float buffer with the common genes as
+        columns. Missing genes and missing values are set to zero.
+        The copy is made in blocks of rows so that any temporary arrays
+        are small.
+
+        Args:
+            data (pandas.DataFrame ~ (num_samples, num_genes)): any expression data
+            gene_list (optional; List[str]): a list of gene ids
+            out (optional; numpy array ~ (num_samples, num_common_genes)):
+                a float buffer to write into.
+            block_size (optional; int): the number of rows per block.
+            n_jobs (optional; int): the number of threads.
+            dtype (optional; numpy dtype): the float type of a new buffer;
+                Normalizer.dtype if None.
+            keep_dtype (optional; bool): if no dtype is given, use the type of
+                the data when it has a single type and no genes are missing.
+
+        Returns:
+            values (numpy array ~ (num_samples, num_common_genes)),
+            common_genes (pandas.Index),
+            lengths (numpy array ~ (num_common_genes,))
+
+        """
+        common_genes, indexer, lengths = self._reindex_plan(data.columns, gene_list)
+        shape = (len(data), len(common_genes))
+        values = data.values
+        missing = indexer < 0
+        if dtype is None:
+            dtype = self.dtype
+            if keep_dtype and not missing.any() and data.dtypes.nunique() <= 1:
+                dtype = values.dtype
+        if out is None:
+            out = numpy.empty(shape, dtype=dtype)
+        assert out.shape == shape, "out must have shape {}".format(shape)
+
+        def copy_rows(first, last):
+            for start in range(first, last, block_size):
+                stop = min(start + block_size, last)
+                block = out[start:stop]
+                if values.dtype == out.dtype:
+                    numpy.take(values[start:stop], indexer, axis=1,
+                               out=block, mode='clip')
+                else:
+                    block[:] = numpy.take(values[start:stop], indexer,
+                                          axis=1, mode='clip')
+                block[:, missing] = 0
+                numpy.copyto(block, 0, where=numpy.isnan(block))
+
+        _map_row_blocks(copy_rows, shape[0], n_jobs)
+        return out, common_genes, lengths
+
+    def _impute_values(self, values, index, columns, imputer):
+        """
+        Apply an imputer to a float buffer, keeping the result in the buffer.
+        Imputers that take an inplace argument (e.g., impute) are allowed to
+        overwrite the buffer instead of making a copy.
+
+        Args:
+            values (numpy array ~ (num_samples, num_genes))
+            index (pandas.Index): the samples
+            columns (pandas.Index): the genes
+            imputer (callable)
+
+        Returns:
+            values (numpy array ~ (num_samples, num_genes))
+
+        """
+        if imputer is do_nothing:
+            return values
+        frame = pandas.DataFrame(values, index=index, columns=columns, copy=False)
+        if _accepts_inplace(imputer):
+            imputed = imputer(frame, inplace=True)
+        else:
+            imputed = imputer(frame)
+        imputed_values = numpy.asarray(imputed)
+        if not numpy.may_share_memory(imputed_values, values):
+            numpy.copyto(values, imputed_values)
+        return values
+
+    def _normalize_rows(self, values, total=10**6, n_jobs=1):
+        """
+        Scale each row of a float buffer in place so that it sums to total.
+
+        Args:
+            values (numpy array ~ (num_samples, num_genes))
+            total (optional; float)
+            n_jobs (optional; int): the number of threads.
+
+        Returns:
+            values (numpy array ~ (num_samples, num_genes))
+
+        """
+        def normalize_rows(start, stop):
+            block = values[start:stop]
+            with numpy.errstate(divide='ignore', invalid='ignore'):
+                block *= (total / block.sum(axis=1, dtype=numpy.float64))[:, None]
 
-    Returns:
-        pandas.DataFrame
+        _map_row_blocks(normalize_rows, len(values), n_jobs)
+        return values
 
-    """
-    return data.groupby(data.columns, axis=1).sum()
+    def _tpm_values(self, data, gene_list, imputer, out=None, lengths=True,
+                    n_jobs=1, dtype=None):
+        """
+        Reindex, impute and transform data into TPM on a single float buffer.
 
+        Args:
+            data (pandas.DataFrame ~ (num_samples, num_genes))
+            gene_list (List[str]): a list of gene ids
+            imputer (callable)
+            out (optional; numpy array ~ (num_samples, num_common_genes))
+            lengths (optional; bool): whether to divide by the gene lengths.
+            n_jobs (optional; int): the number of threads.
+            dtype (optional; numpy dtype): the float type of a new buffer.
 
-def impute(data, scale=0.5):
-    """
-    Replace any zeros in each row with a fraction of the smallest non-zero
-    value in the corresponding row.
+        Returns:
+            values (numpy array ~ (num_samples, num_common_genes)),
+            common_genes (pandas.Index)
 
-    Args:
-        data (pandas.DataFrame ~ (num_samples, num_genes))
-        scale (optional; float)
+        """
+        values, common_genes, gene_lengths = self._reindex_values(
+            data, gene_list, out, n_jobs=n_jobs, dtype=dtype)
+        values = self._impute_values(values, data.index, common_genes, imputer)
+        if lengths:
+            def divide_rows(start, stop):
+                numpy.divide(values[start:stop], gene_lengths, out=values[start:stop])
+
+            _map_row_blocks(divide_rows, len(values), n_jobs)
+        return self._normalize_rows(values, n_jobs=n_jobs), common_genes
+
+    def _reindex_sparse(self, data, columns, gene_list=None, lengths=False,
+                        dtype=None):
+        """
+        Reindex a sparse matrix to the common genes by multiplying it with
+        a sparse selection matrix, optionally dividing by the gene lengths
+        in the same product. Missing values are set to zero.
 
-    Returns:
-        imputed data (pandas.DataFrame ~ (num_samples, num_genes))
+        Args:
+            data (scipy.sparse matrix ~ (num_samples, num_genes))
+            columns (List[str]): the gene ids of the columns of data
+            gene_list (optional; List[str]): a list of gene ids
+            lengths (optional; bool): whether to divide by the gene lengths.
+            dtype (optional; numpy dtype): Normalizer.dtype if None.
 
-    """
-    v = scale * data[data > 0].min(axis=1)
-    data_fill = data.fillna(0)
-    return data_fill + (data_fill == 0).multiply(v, axis=0)
+        Returns:
+            values (scipy.sparse.csr_matrix ~ (num_samples, num_common_genes)),
+            common_genes (pandas.Index)
 
+        """
+        assert columns is not None, "columns are required for sparse data"
+        columns = pandas.Index(columns)
+        assert len(columns) == data.shape[1], "columns must match the data"
+        common_genes, indexer, gene_lengths = self._reindex_plan(columns, gene_list)
+        present = numpy.flatnonzero(indexer >= 0)
+        weights = 1 / gene_lengths[present] if lengths else numpy.ones(len(present))
+        dtype = self.dtype if dtype is None else dtype
+        selection = scipy.sparse.csr_matrix(
+            (weights.astype(dtype), (indexer[present], present)),
+            shape=(len(columns), len(common_genes)))
+        matrix = scipy.sparse.csr_matrix(data, dtype=dtype, copy=True)
+        numpy.copyto(matrix.data, 0, where=numpy.isnan(matrix.data))
+        matrix.eliminate_zeros()
+        return (matrix @ selection).tocsr(), common_genes
+
+    def _normalize_sparse_rows(self, values, total=10**6):
+        """
+        Scale each row of a CSR matrix in place so that it sums to total.
 
-class Normalizer(object):
-    """
-    Tools to change units of expression data, primarily to convert to TPM.
+        Args:
+            values (scipy.sparse.csr_matrix ~ (num_samples, num_genes))
+            total (optional; float)
 
-    Attributes:
-        gene_lengths (DataFrame): bp lengths for genes.
+        Returns:
+            values (scipy.sparse.csr_matrix ~ (num_samples, num_genes))
 
-    """
-    def __init__(self, identifier='symbol'):
         """
-        Tools to normalize expression data and transform into TPM.
+        sums = numpy.asarray(values.sum(axis=1, dtype=numpy.float64)).ravel()
+        with numpy.errstate(divide='ignore', invalid='ignore'):
+            scale = total / sums
+        values.data *= numpy.repeat(scale, numpy.diff(values.indptr))
+        return values
+
+    def _tpm_sparse(self, data, columns, gene_list, imputer, out, lengths=True,
+                    dtype=None):
+        """
+        Reindex and transform a sparse matrix into TPM, keeping it sparse.
 
         Args:
-            identifier (str)
+            data (scipy.sparse matrix ~ (num_samples, num_genes))
+            columns (List[str]): the gene ids of the columns of data
+            gene_list (List[str]): a list of gene ids
+            imputer (callable): must be do_nothing
+            out (None): buffers are not supported for sparse data
+            lengths (optional; bool): whether to divide by the gene lengths.
+            dtype (optional; numpy dtype)
 
         Returns:
-            Normalizer
+            scipy.sparse.csr_matrix ~ (num_samples, num_common_genes)
 
         """
-        # read the gene lengths
-        p = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'data', 'gtex')
-        gene_info = pandas.read_csv(os.path.join(p, 'gene_info.csv'), sep='\t')
-        gene_info.set_index('gene_id', inplace=True)
-        self.gene_lengths = gene_info['bp_length']
-        # clean the ensemble gene ids
-        self.gene_lengths.index = convert.clean_ensembl_ids(self.gene_lengths.index)
-        self.gene_lengths = self.gene_lengths[~self.gene_lengths.index.duplicated(keep='first')]
-        # convert the gene ids
-        self.converter = None
-        if identifier is not 'ensembl_gene_id':
-            self.converter = convert.IDConverter('ensembl_gene_id', identifier)
-            self.gene_lengths.index = self.converter.convert_list(list(self.gene_lengths.index))
-        self.describer = describe.Describer(identifier)
-        # drop any NaN and duplicate ids
-        self.gene_lengths = self.gene_lengths[~self.gene_lengths.index.isnull()]
-        self.gene_lengths = self.gene_lengths[~self.gene_lengths.index.duplicated(keep='first')]
+        assert imputer is do_nothing, "imputing zeros would densify sparse data"
+        assert out is None, "out is not supported for sparse data"
+        values, _ = self._reindex_sparse(data, columns, gene_list, lengths, dtype)
+        return self._normalize_sparse_rows(values)
 
-    def _get_common_genes(self, gene_list):
+    def common_genes(self, gene_list=None):
         """
-        Get a set of identifiers that occur in GTEx and, therefore,
-        have gene lengths.
+        The genes that the transforms reindex to, in order.
+        These are the columns of the sparse matrices returned for sparse data.
 
         Args:
-            gene_list (List[str])
+            gene_list (optional; List[str]): a list of gene ids
 
         Returns:
-            common_genes (List[str])
+            pandas.Index
 
         """
-        if gene_list is None:
-            # reindex to all of the gtex genes
-            return list(self.gene_lengths.index)
-        # select the genes in the gene_list that also occur in gtex
-        common_genes = [gene for gene in gene_list if gene in self.gene_lengths.index]
-        # warn the user about any genes that are not in gtex and are being dropped
-        missing_genes = list(set(gene_list) - set(common_genes))
-        if len(missing_genes) > 0:
-            warnings.warn("Could not find identifiers: {}".format(missing_genes))
-        return common_genes
+        return pandas.Index(self._get_common_genes(gene_list))
 
-    def reindex(self, data, gene_list=None):
+    def reindex(self, data, gene_list=None, columns=None, dtype=None):
         """
         Reindexes the dataframe so that it has the same genes as the gtex
         dataset from recount.
 
+        Sparse data (any scipy.sparse matrix, with the gene ids given by
+        columns) is reindexed to a scipy.sparse.csr_matrix whose columns are
+        common_genes(gene_list).
+
         Args:
-            data (pandas.DataFrame ~ (num_samples, num_genes)): any expression data
+            data (pandas.DataFrame or scipy.sparse matrix ~ (num_samples, num_genes)):
+                any expression data
             gene_list (List[str]): a list of gene ids
+            columns (optional; List[str]): the gene ids of sparse data
+            dtype (optional; numpy dtype): the type of the output. If None, the
+                type of the data is kept when no genes need to be filled in,
+                and Normalizer.dtype is used otherwise.
 
         Returns:
-            pandas.DataFrame ~ (num_samples, num_common_genes)
+            pandas.DataFrame or scipy.sparse.csr_matrix ~ (num_samples, num_common_genes)
 
         """
-        common_genes = self._get_common_genes(gene_list)
-        common = data.reindex(columns=common_genes)
-        common.fillna(0, inplace=True)
-        return common
-
-    def tpm_from_rpkm(self, data, gene_list=None, imputer=do_nothing):
+        if scipy.sparse.issparse(data):
+            return self._reindex_sparse(data, columns, gene_list, dtype=dtype)[0]
+        values, common_genes, _ = self._reindex_values(data, gene_list, dtype=dtype,
+                                                       keep_dtype=True)
+        return pandas.DataFrame(values, index=data.index, columns=common_genes)
+
+    def tpm_from_rpkm(self, data, gene_list=None, imputer=do_nothing, out=None,
+                      columns=None, dtype=None):
         """
         Transform data from RPKM to TPM.
         Unless a gene list is specified, genes are reindex to GTEx:
@@ -141,19 +1248,36 @@ class Normalizer(object):
             - Any genes not present in GTEx are dropped.
         Takes an optional imputation method applied after reindexing.
 
+        The transform is computed in place on a single float buffer, which
+        may be supplied with the out argument.
+
+        Sparse data (any scipy.sparse matrix, with the gene ids given by
+        columns) stays sparse and is returned as a scipy.sparse.csr_matrix
+        whose columns are common_genes(gene_list). Sparse data cannot be
+        imputed.
+
         Args:
-            data (pandas.DataFrame ~ (num_samples, num_genes)): RPKM data
+            data (pandas.DataFrame or scipy.sparse matrix ~ (num_samples, num_genes)):
+                RPKM data
             gene_list (optional; List[str]): a list of gene ids
             imputer (optional; callable)
+            out (optional; numpy array ~ (num_samples, num_common_genes))
+            columns (optional; List[str]): the gene ids of sparse data
+            dtype (optional; numpy dtype): the float type; Normalizer.dtype if None.
 
         Returns:
-            pandas.DataFrame
+            pandas.DataFrame or scipy.sparse.csr_matrix
 
         """
-        subset = imputer(self.reindex(data, gene_list))
-        return 10**6 * subset.divide(subset.sum(axis=1), axis='index')
-
-    def tpm_from_counts(self, data, gene_list=None, imputer=do_nothing):
+        if scipy.sparse.issparse(data):
+            return self._tpm_sparse(data, columns, gene_list, imputer, out,
+                                    lengths=False, dtype=dtype)
+        values, common_genes = self._tpm_values(data, gene_list, imputer, out,
+                                                lengths=False, dtype=dtype)
+        return pandas.DataFrame(values, index=data.index, columns=common_genes)
+
+    def tpm_from_counts(self, data, gene_list=None, imputer=do_nothing, out=None,
+                        n_jobs=1, columns=None, dtype=None):
         """
         Transform data from counts to TPM.
         Unless a gene list is specified, genes are reindex to GTEx:
@@ -161,20 +1285,37 @@ class Normalizer(object):
             - Any genes not present in GTEx are dropped.
         Takes an optional imputation method applied after reindexing.
 
+        The transform is computed in place on a single float buffer, which
+        may be supplied with the out argument. The rows are split across
+        n_jobs threads.
+
+        Sparse data (any scipy.sparse matrix, with the gene ids given by
+        columns) stays sparse through the length scaling and normalization
+        and is returned as a scipy.sparse.csr_matrix whose columns are
+        common_genes(gene_list). Sparse data cannot be imputed.
+
         Args:
-            data (pandas.DataFrame ~ (num_samples, num_genes)): count data
+            data (pandas.DataFrame or scipy.sparse matrix ~ (num_samples, num_genes)):
+                count data
             gene_list (optional; List[str]): a list of gene ids
             imputer (optional; callable)
+            out (optional; numpy array ~ (num_samples, num_common_genes))
+            n_jobs (optional; int): the number of threads; not used for sparse data.
+            columns (optional; List[str]): the gene ids of sparse data
+            dtype (optional; numpy dtype): the float type; Normalizer.dtype if None.
 
         Returns:
-            pandas.DataFrame
+            pandas.DataFrame or scipy.sparse.csr_matrix
 
         """
-        subset = imputer(self.reindex(data, gene_list))
-        normed = subset.divide(self.gene_lengths[subset.columns], axis='columns')
-        return 10**6 * normed.divide(normed.sum(axis=1), axis='rows')
-
-    def tpm_from_subset(self, data, gene_list=None, imputer=do_nothing):
+        if scipy.sparse.issparse(data):
+            return self._tpm_sparse(data, columns, gene_list, imputer, out,
+                                    dtype=dtype)
+        values, common_genes = self._tpm_values(data, gene_list, imputer, out,
+                                                n_jobs=n_jobs, dtype=dtype)
+        return pandas.DataFrame(values, index=data.index, columns=common_genes)
+
+    def tpm_from_subset(self, data, gene_list=None, imputer=do_nothing, dtype=None):
         """
         Renormalize a subset of genes already in TPM.
         Unless a gene list is specified, genes are reindex to GTEx:
@@ -186,14 +1327,16 @@ class Normalizer(object):
             data (pandas.DataFrame ~ (num_samples, num_genes)): TPM data
             gene_list (optional; List[str]): a list of gene ids
             imputer (optional; callable)
+            dtype (optional; numpy dtype): the float type; Normalizer.dtype if None.
 
         Returns:
             pandas.DataFrame
 
         """
-        return self.tpm_from_rpkm(data, gene_list, imputer)
+        return self.tpm_from_rpkm(data, gene_list, imputer, dtype=dtype)
 
-    def clr_from_tpm(self, data, gene_list=None, imputer=do_nothing):
+    def clr_from_tpm(self, data, gene_list=None, imputer=do_nothing, n_jobs=1,
+                     dtype=None):
         """
         Compute the centered log ratio transform of data in TPM format.
         Unless a gene list is specified, genes are reindex to GTEx:
@@ -201,20 +1344,33 @@ class Normalizer(object):
             - Any genes not present in GTEx are dropped.
         Takes an optional imputation method applied after reindexing.
 
+        The logarithms are taken in the float type of the output, but the
+        means of the log values are accumulated in float64.
+
         Args:
             data (pandas.DataFrame ~ (num_samples, num_genes)): TPM data
             gene_list (optional; List[str]): a list of gene ids
             imputer (optional; callable)
+            n_jobs (optional; int): the number of threads.
+            dtype (optional; numpy dtype): the float type; Normalizer.dtype if None.
 
         Returns:
             pandas.DataFrame ~ (num_samples, num_genes)
 
         """
-        imputed = self.tpm_from_subset(data, gene_list, imputer)
-        log_transformed = numpy.log(imputed)
-        return log_transformed.subtract(log_transformed.mean(axis=1), axis=0)
+        values, common_genes = self._tpm_values(data, gene_list, imputer,
+                                                lengths=False, n_jobs=n_jobs,
+                                                dtype=dtype)
+
+        def clr_rows(start, stop):
+            block = values[start:stop]
+            numpy.log(block, out=block)
+            block -= block.mean(axis=1, dtype=numpy.float64, keepdims=True)
+
+        _map_row_blocks(clr_rows, len(values), n_jobs)
+        return pandas.DataFrame(values, index=data.index, columns=common_genes)
 
-    def tpm_from_clr(self, data, gene_list=None):
+    def tpm_from_clr(self, data, gene_list=None, dtype=None):
         """
         Compute data in TPM format from centered log ratio transformed data.
         Unless a gene list is specified, genes are reindex to GTEx:
@@ -224,82 +1380,344 @@ class Normalizer(object):
         Args:
             data (pandas.DataFrame ~ (num_samples, num_genes)): CLR data
             gene_list (optional; List[str]): a list of gene ids
+            dtype (optional; numpy dtype): the float type; Normalizer.dtype if None.
 
         Returns:
             pandas.DataFrame ~ (num_samples, num_genes)
 
         """
-        return self.tpm_from_rpkm(numpy.exp(data), gene_list)
+        return self.tpm_from_rpkm(numpy.exp(data), gene_list, dtype=dtype)
 
     def alr_from_tpm(self, data, reference_genes, gene_list=None,
-                     imputer=do_nothing):
+                     imputer=do_nothing, dtype=None):
         """
         Compute the additive log ratio transform of data in TPM format.
         This transform normalizes by the geometric mean of the reference genes,
         and drops the reference genes from the data set.
 
+        Several reference panels can be compared in one call by passing a dict
+        of reference gene lists; the data are reindexed, imputed and logged
+        once and shared by all of the panels.
+
         Args:
             data (pandas.DataFrame ~ (num_samples, num_genes)): TPM data
-            reference_genes (List[str]): a list of gene ids to use as the
-                references in the ALR transform
+            reference_genes (List[str] or dict): a list of gene ids to use as
+                the references in the ALR transform, or a dict of such lists
             gene_list (optional; List[str]): a list of gene ids
             imputer (optional; callable)
+            dtype (optional; numpy dtype): the float type; Normalizer.dtype if None.
 
         Returns:
-            pandas.DataFrame ~ (num_samples, num_genes - num_reference_genes)
+            pandas.DataFrame ~ (num_samples, num_genes - num_reference_genes),
+                or a dict of them with the keys of reference_genes
 
         """
-        common_genes = self._get_common_genes(gene_list)
-        common_references = [gene for gene in reference_genes if gene in common_genes]
-        genes_to_keep = [gene for gene in common_genes if gene not in common_references]
-        imputed = self.tpm_from_subset(data, genes_to_keep + common_references, imputer)
-        log_transformed = numpy.log(imputed)
-        refs = log_transformed[common_references].mean(axis=1)
-        return log_transformed[genes_to_keep].subtract(refs, axis=0)
-
-    def z_score_from_clr(self, data, tissues, gene_list=None):
+        values, common_genes, _ = self._reindex_values(data, gene_list, dtype=dtype)
+        values = self._impute_values(values, data.index, common_genes, imputer)
+        # the ratios do not depend on the scale of each row,
+        # so there is no need to renormalize to TPM
+        numpy.log(values, out=values)
+
+        def alr(references, inplace=False):
+            positions = common_genes.get_indexer(references)
+            positions = positions[positions >= 0]
+            keep = numpy.ones(len(common_genes), dtype=bool)
+            keep[positions] = False
+            reference = values[:, positions].mean(
+                axis=1, dtype=numpy.float64, keepdims=True).astype(values.dtype)
+            if inplace:
+                numpy.subtract(values, reference, out=values)
+                alr_values = numpy.compress(keep, values, axis=1)
+            else:
+                alr_values = values[:, keep] - reference
+            return pandas.DataFrame(alr_values, index=data.index,
+                                    columns=common_genes[keep])
+
+        if isinstance(reference_genes, dict):
+            return {name: alr(references)
+                    for name, references in reference_genes.items()}
+        # with a single panel the subtraction can be done in the buffer
+        return alr(reference_genes, inplace=True)
+
+    def z_score_from_clr(self, data, tissues, gene_list=None, n_jobs=1, dtype=None):
         """
         Compute the z-score of the clr'd tpm data relative to healthy tissue
-        in GTEx.
+        in GTEx. Samples are grouped by tissue and the GTEx mean and standard
+        deviation of each tissue are broadcast over its samples.
+        Genes without GTEx statistics are NaN.
 
         Args:
             data (pandas.DataFrame ~ (num_samples, num_genes)): CLR data
             tissues (pandas.Series) ~ (num_samples)): tissues of data samples
             gene_list (optional; List[str]): a list of gene ids
+            n_jobs (optional; int): the number of threads.
+            dtype (optional; numpy dtype): the float type; Normalizer.dtype if None.
 
         Returns:
             pandas.DataFrame ~ (num_samples, num_genes - num_reference_genes)
 
         """
-        # get the clr tissue stats from GTEx
-        mean_clr = self.describer.tissue_stats['mean_clr']
-        std_clr = self.describer.tissue_stats['std_clr']
-
-        # convert gene IDs from Ensembl to the identifier, if needed
-        # duplicates are dropped!
-        if self.converter is not None:
-            mean_clr.index = self.converter.convert_list(mean_clr.index)
-            mean_clr = mean_clr[mean_clr.index.notnull()]
-            mean_clr = mean_clr[~mean_clr.index.duplicated(keep='first')]
-            std_clr.index = self.converter.convert_list(std_clr.index)
-            std_clr = std_clr[std_clr.index.notnull()]
-            std_clr = std_clr[~std_clr.index.duplicated(keep='first')]
+        # get the clr tissue stats from GTEx with gene IDs converted from
+        # Ensembl to the identifier; duplicates are dropped!
+        mean_clr = self.describer.get_reference('mean_clr')
+        std_clr = self.describer.get_reference('std_clr')
 
         if gene_list is None:
             gene_list = data.columns
 
-        mean_clr = mean_clr.reindex(gene_list)
-        std_clr = std_clr.reindex(gene_list)
+        values, common_genes, _ = self._reindex_values(data, gene_list, n_jobs=n_jobs,
+                                                       dtype=dtype)
+        # (num_tissues, num_genes) reference arrays and the tissue of each sample
+        mean = mean_clr.reindex(common_genes).values.T.astype(numpy.float64)
+        std = std_clr.reindex(common_genes).values.T.astype(numpy.float64)
+        codes = mean_clr.columns.get_indexer(tissues.reindex(data.index))
+        assert (codes >= 0).all(), "Unknown tissues in tissues"
+
+        def z_score_rows(start, stop):
+            _z_score_by_tissue(values[start:stop], codes[start:stop], mean, std)
+
+        _map_row_blocks(z_score_rows, len(values), n_jobs)
+        zscore = pandas.DataFrame(values, index=data.index, columns=common_genes)
+        return zscore.reindex(columns=gene_list, copy=False)
+
+    def outliers_from_clr(self, data, tissues, gene_list=None, alpha=0.05,
+                          chunk_size=1000):
+        """
+        Find genes with outlying expression relative to healthy tissue in GTEx.
+
+        Samples are processed in chunks. The clr'd tpm data are converted to
+        z-scores against the GTEx tissue of each sample and then to two-sided
+        p-values from a standard normal distribution. The Benjamini-Hochberg
+        procedure is applied separately to the genes of each sample, and only
+        the outliers with q-values at or below alpha are kept.
+        Genes without GTEx statistics are ignored.
+
+        Args:
+            data (pandas.DataFrame ~ (num_samples, num_genes)): CLR data
+            tissues (pandas.Series) ~ (num_samples)): tissues of data samples
+            gene_list (optional; List[str]): a list of gene ids
+            alpha (optional; float): the false discovery rate for each sample.
+            chunk_size (optional; int): the number of samples per chunk.
+
+        Returns:
+            pandas.DataFrame ~ (num_outliers, 5): with columns 'sample', 'gene',
+                'z_score', 'p_value' and 'q_value'.
+
+        """
+        genes = data.columns if gene_list is None else pandas.Index(gene_list)
+        mean_clr = self.describer.get_reference('mean_clr', genes)
+        std_clr = self.describer.get_reference('std_clr', genes)
+        valid = (numpy.isfinite(mean_clr.values) & numpy.isfinite(std_clr.values)
+                 & (std_clr.values > 0)).all(axis=1) & genes.isin(data.columns)
+        genes = genes[valid]
+        mean = mean_clr.values[valid].T.astype(numpy.float64)
+        std = std_clr.values[valid].T.astype(numpy.float64)
+
+        codes = mean_clr.columns.get_indexer(tissues.reindex(data.index))
+        assert (codes >= 0).all(), "Unknown tissues in tissues"
+        columns = data.columns.get_indexer(genes)
+        values = data.values
+
+        outliers = []
+        for start in range(0, len(data), chunk_size):
+            stop = start + chunk_size
+            chunk_codes = codes[start:stop]
+            z = numpy.asarray(values[start:stop][:, columns], dtype=numpy.float64)
+            _z_score_by_tissue(z, chunk_codes, mean, std)
+            p = erfc(numpy.abs(z) / numpy.sqrt(2))
+            q = benjamini_hochberg(p)
+            rows, cols = numpy.nonzero(q <= alpha)
+            outliers.append(pandas.DataFrame({
+                    'sample': data.index[start + rows],
+                    'gene': genes[cols],
+                    'z_score': z[rows, cols],
+                    'p_value': p[rows, cols],
+                    'q_value': q[rows, cols]},
+                    columns=['sample', 'gene', 'z_score', 'p_value', 'q_value']))
+        if not outliers:
+            return pandas.DataFrame(
+                    columns=['sample', 'gene', 'z_score', 'p_value', 'q_value'])
+        return pandas.concat(outliers, ignore_index=True)
+
+    def _percentiles(self, data, tissues, gene_list, sketch, transform):
+        """
+        Compute the percentile of each value within the GTEx distribution of
+        the gene in the tissue of the sample.
+
+        Args:
+            data (pandas.DataFrame ~ (num_samples, num_genes))
+            tissues (pandas.Series) ~ (num_samples)): tissues of data samples
+            gene_list (List[str]): a list of gene ids
+            sketch (str): 'quantiles' or 'quantiles_clr'
+            transform (callable): applied to the data to match the sketch.
+
+        Returns:
+            pandas.DataFrame ~ (num_samples, num_genes)
+
+        """
+        genes = data.columns if gene_list is None else pandas.Index(gene_list)
+        quantiles = self.describer.get_reference(sketch, genes)
+        values = transform(data.reindex(columns=genes).values.astype(numpy.float64))
+        tissues = tissues.reindex(data.index).values
+        percentiles = numpy.empty_like(values)
+        for tissue in numpy.unique(tissues):
+            rows = tissues == tissue
+            percentiles[rows] = percentile_ranks(values[rows], quantiles[tissue].values)
+        return pandas.DataFrame(percentiles, index=data.index, columns=genes)
+
+    def percentile_from_tpm(self, data, tissues, gene_list=None):
+        """
+        Compute the percentile of the tpm data within the distribution of
+        healthy tissue in GTEx, from the quantile sketches in tissue_stats.
+        Genes without GTEx statistics are NaN.
+
+        Args:
+            data (pandas.DataFrame ~ (num_samples, num_genes)): TPM data
+            tissues (pandas.Series) ~ (num_samples)): tissues of data samples
+            gene_list (optional; List[str]): a list of gene ids
+
+        Returns:
+            pandas.DataFrame ~ (num_samples, num_genes): percentiles in [0, 100]
+
+        """
+        return self._percentiles(data, tissues, gene_list, 'quantiles', numpy.log1p)
+
+    def percentile_from_clr(self, data, tissues, gene_list=None):
+        """
+        Compute the percentile of the clr'd tpm data within the distribution
+        of healthy tissue in GTEx, from the quantile sketches in tissue_stats.
+        Genes without GTEx statistics are NaN.
+
+        Args:
+            data (pandas.DataFrame ~ (num_samples, num_genes)): CLR data
+            tissues (pandas.Series) ~ (num_samples)): tissues of data samples
+            gene_list (optional; List[str]): a list of gene ids
+
+        Returns:
+            pandas.DataFrame ~ (num_samples, num_genes): percentiles in [0, 100]
+
+        """
+        return self._percentiles(data, tissues, gene_list, 'quantiles_clr', do_nothing)
+
+    def iter_dense_chunks(self, data, columns, method='clr_from_tpm', index=None,
+                          chunk_size=1000, **kwargs):
+        """
+        Apply a transform that densifies its output (e.g., clr_from_tpm or
+        alr_from_tpm, which take logarithms of the imputed zeros) to sparse
+        data, one dense chunk of samples at a time.
+
+        Args:
+            data (scipy.sparse matrix ~ (num_samples, num_genes))
+            columns (List[str]): the gene ids of the columns of data
+            method (optional; str): the name of a Normalizer transform
+            index (optional; List[str]): the sample ids of the rows of data
+            chunk_size (optional; int): the number of samples per chunk.
+            kwargs: passed to the transform, e.g., gene_list or imputer.
+
+        Yields:
+            pandas.DataFrame ~ (chunk_size, num_common_genes)
+
+        """
+        matrix = scipy.sparse.csr_matrix(data)
+        index = pandas.RangeIndex(matrix.shape[0]) if index is None else pandas.Index(index)
+        transform = getattr(self, method)
+        for start in range(0, matrix.shape[0], chunk_size):
+            stop = start + chunk_size
+            chunk = pandas.DataFrame(matrix[start:stop].toarray(),
+                                     index=index[start:stop], columns=columns)
+            yield transform(chunk, **kwargs)
+
+    def transform_file(self, input_file, output_file, method='tpm_from_counts',
+                       chunk_size=1000, key='data', verbose=False, **kwargs):
+        """
+        Apply a row-independent transform to an expression data file that may
+        not fit in memory, reading and writing chunks of samples
+        (see read_chunks and ChunkWriter for the supported formats).
+        Unless a gene list is given, every chunk is reindexed to the GTEx genes
+        so that all chunks have the same columns.
+
+        Args:
+            input_file (str): a CSV, TSV, HDF5 or parquet file.
+            output_file (str): a CSV, TSV, HDF5 or parquet file.
+            method (optional; str): 'tpm_from_counts', 'tpm_from_rpkm',
+                'tpm_from_subset', 'clr_from_tpm', 'tpm_from_clr' or 'alr_from_tpm'
+            chunk_size (optional; int): the number of samples per chunk.
+            key (optional; str): the key of the data in HDF5 files.
+            verbose (optional; bool): print the progress after each chunk.
+            kwargs: passed to the transform, e.g., gene_list or imputer.
+
+        Returns:
+            dict: the number of 'rows', the 'seconds' taken and the
+                'rows_per_second'.
+
+        """
+        streaming = ['tpm_from_counts', 'tpm_from_rpkm', 'tpm_from_subset',
+                     'clr_from_tpm', 'tpm_from_clr', 'alr_from_tpm']
+        assert method in streaming, \
+            "method must be one of the row-independent transforms {}".format(streaming)
+        transform = getattr(self, method)
+        rows = 0
+        start = time.time()
+        with ChunkWriter(output_file, key) as writer:
+            for chunk in read_chunks(input_file, chunk_size, key):
+                writer.write(transform(chunk, **kwargs))
+                rows += len(chunk)
+                if verbose:
+                    print('processed {} rows at {:.1f} rows/sec'.format(
+                            rows, rows / (time.time() - start)))
+        seconds = time.time() - start
+        return {'rows': rows, 'seconds': seconds,
+                'rows_per_second': rows / seconds if seconds > 0 else float('inf')}
+
+    def kernel(self, genes, tissue=None, dtype=None):
+        """
+        Precompute a NormalizationKernel for single samples whose values are
+        given in the order of genes.
+
+        Args:
+            genes (List[str]): the gene ids of the input vectors, in order.
+            tissue (optional; str): the GTEx tissue for z-scores.
+            dtype (optional; numpy dtype): the float type; Normalizer.dtype if None.
+
+        Returns:
+            NormalizationKernel
+
+        """
+        return NormalizationKernel(self, genes, tissue,
+                                   self.dtype if dtype is None else dtype)
+
+    def gtex_cutoffs(self, tissue, gene_list=None, stats=None, clr=True):
+        """
+        Get per-gene ordinal cutoffs from the quartiles of a GTEx tissue,
+        for use with ordinalize.
+
+        Args:
+            tissue (str): a GTEx tissue
+            gene_list (optional; List[str]): a list of gene ids.
+                Genes that are not in GTEx have NaN cutoffs.
+            stats (optional; List[str]): the statistics to use as cutoffs, in
+                increasing order. Default: ['lower_quartile', 'median',
+                'upper_quartile'].
+            clr (optional; bool): use the statistics of the clr'd data (True)
+                or of the TPM data (False).
 
-        mean_expression = mean_clr[tissues].transpose().set_index(tissues.index)
-        std_expression = std_clr[tissues].transpose().set_index(tissues.index)
-        data_subset = self.reindex(data, gene_list)
-        return (data_subset - mean_expression)/std_expression
+        Returns:
+            pandas.DataFrame ~ (num_genes, num_stats)
 
-    def ordinalize(self, data, cutoffs, min_value=0):
+        """
+        if stats is None:
+            stats = ['lower_quartile', 'median', 'upper_quartile']
+        suffix = '_clr' if clr else ''
+        return pandas.DataFrame({stat: self.describer.get_reference(
+                                    stat + suffix, gene_list)[tissue]
+                                 for stat in stats}, columns=stats)
+
+    def ordinalize(self, data, cutoffs, min_value=0, dtype=None, block_size=1024):
         """
         Convert data into ordinal values given cutoffs between ordinal boundaries.
-        Returns the same type as the input data.
+        Returns the same type as the input data, unless a dtype is given;
+        the ordinal values are computed on the whole array in blocks of rows
+        and can be stored as small integers, e.g., dtype=numpy.int8.
 
         Example:
             If cutoffs = [-2, 2] and min_value = -1, then
@@ -309,17 +1727,52 @@ class Normalizer(object):
 
         Args:
             data (pandas.DataFrame ~ (num_samples, num_genes)): any expression data
-            cutoffs (List[float]): cutoffs between ordinal boundaries.
+            cutoffs (List[float] or pandas.DataFrame ~ (num_genes, num_cutoffs)):
+                cutoffs between ordinal boundaries.
                 No lower or upper bounds should be given, e.g. to binarize this
                 argument should be a list with 1 value.
+                A DataFrame gives increasing cutoffs for each gene, indexed by
+                gene (see gtex_cutoffs); genes without cutoffs are set to
+                min_value.
+            min_value (optional; int): the smallest ordinal value.
+            dtype (optional; numpy dtype): the type of the ordinal values.
+            block_size (optional; int): the number of rows per block.
 
         Returns:
             pandas.DataFrame ~ (num_samples, num_genes): ordinal values,
-                typed as the input data.
+                typed as the input data unless a dtype is given.
 
         """
-        ordinalizer = partial(numpy.searchsorted, cutoffs)
-        return data.apply(ordinalizer).astype(data.dtypes) + min_value
+        if isinstance(cutoffs, pandas.DataFrame):
+            per_gene = cutoffs.reindex(data.columns).values.T
+        else:
+            per_gene = None
+            cutoffs = numpy.asarray(cutoffs)
+        num_cutoffs = len(cutoffs) if per_gene is None else len(per_gene)
+        # the smallest integer type that can hold the ordinal values
+        ordinal_dtype = numpy.result_type(numpy.min_scalar_type(min_value),
+                                          numpy.min_scalar_type(min_value + num_cutoffs))
+
+        values = data.values
+        ordinals = numpy.empty(values.shape, dtype=ordinal_dtype)
+        for start in range(0, len(values), block_size):
+            block = values[start:start+block_size]
+            if per_gene is None:
+                # values equal to a cutoff belong to the lower ordinal
+                ordinals[start:start+block_size] = numpy.digitize(
+                        block, cutoffs, right=True) + min_value
+            else:
+                out = ordinals[start:start+block_size]
+                out[:] = min_value
+                for gene_cutoffs in per_gene:
+                    out += block > gene_cutoffs
+                out[numpy.isnan(block)] = min_value + num_cutoffs
+
+        if dtype is not None:
+            return pandas.DataFrame(ordinals.astype(dtype, copy=False),
+                                    index=data.index, columns=data.columns)
+        ordinals = pandas.DataFrame(ordinals, index=data.index, columns=data.columns)
+        return ordinals.astype(data.dtypes)
 
 
 class RemoveUnwantedVariation(object):
@@ -566,3 +2019,378 @@ class RemoveUnwantedVariation(object):
         """
         with open(filename, 'rb') as f:
             return pickle.load(f)
+
+
+class ExpressionPipeline(object):
+    """
+    A planned sequence of transforms from raw expression data to, e.g.,
+    z-scores, computed in place on a single float buffer.
+
+    The steps are given in the order
+        'tpm_from_counts', 'tpm_from_rpkm' or 'tpm_from_subset' (required),
+        'impute', 'clr', 'ruv' and 'z_score' (all optional),
+    each as a name or as a (name, kwargs) tuple:
+        'impute': {'imputer': callable}, default normalize.impute
+        'ruv': {'model': fitted RemoveUnwantedVariation, 'penalty': float}
+        'z_score': no arguments; the tissues are given to transform.
+    'ruv' and 'z_score' need 'clr'.
+
+    Example:
+        pipeline = ExpressionPipeline(['tpm_from_counts', 'impute', 'clr',
+                                       ('ruv', {'model': ruv}), 'z_score'])
+        zscores = pipeline.transform(counts, tissues)
+
+    Attributes:
+        steps (List[tuple]): (name, kwargs) for each step.
+        identifier (str): the gene identifier of the data.
+        gene_list (List[str]): the genes to reindex to; all GTEx genes if None.
+        dtype (numpy dtype): the float type of the output.
+        normalizer (Normalizer): created on first use.
+
+    """
+    __steps__ = ['tpm_from_counts', 'tpm_from_rpkm', 'tpm_from_subset',
+                 'impute', 'clr', 'ruv', 'z_score']
+
+    def __init__(self, steps, identifier='symbol', gene_list=None,
+                 dtype=numpy.float64):
+        """
+        Plan a pipeline of expression transforms.
+
+        Args:
+            steps (List[str or tuple]): step names or (name, kwargs) tuples.
+            identifier (optional; str): the gene identifier of the data.
+            gene_list (optional; List[str]): a list of gene ids.
+            dtype (optional; numpy dtype): the float type of the output.
+
+        Returns:
+            ExpressionPipeline
+
+        """
+        self.steps = []
+        for step in steps:
+            name, kwargs = (step, {}) if isinstance(step, str) else step
+            assert name in self.__steps__, \
+                "Unknown step {}; steps must be in {}".format(name, self.__steps__)
+            self.steps.append((name, dict(kwargs)))
+        names = [name for name, _ in self.steps]
+        ranks = [max(0, self.__steps__.index(name) - 2) for name in names]
+        assert len(names) > 0 and ranks[0] == 0, \
+            "The first step must be a tpm transform"
+        assert ranks == sorted(set(ranks)), \
+            "Steps must be in the order {}".format(self.__steps__)
+        assert 'clr' in names or not ({'ruv', 'z_score'} & set(names)), \
+            "The 'ruv' and 'z_score' steps need the 'clr' step"
+        self.identifier = identifier
+        self.gene_list = gene_list
+        self.dtype = numpy.dtype(dtype)
+        self._normalizer = None
+        self._plan = None
+
+    @property
+    def normalizer(self):
+        if self._normalizer is None:
+            self._normalizer = Normalizer(self.identifier)
+        return self._normalizer
+
+    def _get_plan(self):
+        """
+        Compute the genes and the reference arrays used by the steps, once.
+
+        Args:
+            None
+
+        Returns:
+            dict
+
+        """
+        if self._plan is not None:
+            return self._plan
+        genes = self.normalizer.common_genes(self.gene_list)
+        plan = {'genes': genes}
+        kwargs = dict(self.steps)
+        if 'ruv' in kwargs:
+            model = kwargs['ruv']['model']
+            assert model._is_fit(), "RUV has not been fit!"
+            means = model.means.reindex(genes).values.astype(numpy.float64)
+            assert not numpy.isnan(means).any(), \
+                "The RUV model must be fit on the genes of the pipeline"
+            plan['ruv_means'] = means if model.center else numpy.zeros(len(genes))
+            plan['ruv_hk'] = genes.get_indexer(model.hk_genes)
+            assert (plan['ruv_hk'] >= 0).all(), \
+                "The RUV housekeeping genes must be in the pipeline"
+            plan['ruv_Vt'] = numpy.asarray(model.Vt)
+        if 'z_score' in kwargs:
+            describer = self.normalizer.describer
+            mean_clr = describer.get_reference('mean_clr', genes)
+            std_clr = describer.get_reference('std_clr', genes)
+            plan['tissues'] = mean_clr.columns
+            plan['mean_clr'] = mean_clr.values.T.astype(numpy.float64)
+            plan['std_clr'] = std_clr.values.T.astype(numpy.float64)
+        self._plan = plan
+        return plan
+
+    def _ruv_values(self, values, plan, penalty):
+        """
+        Remove unwanted variation from a float buffer of clr'd data in place,
+        as in RemoveUnwantedVariation.transform.
+
+        Args:
+            values (numpy array ~ (num_samples, num_genes))
+            plan (dict)
+            penalty (float)
+
+        Returns:
+            values (numpy array ~ (num_samples, num_genes))
+
+        """
+        values -= plan['ruv_means']
+        W = numpy.dot(values[:, plan['ruv_hk']], plan['ruv_Vt'].T)
+        J = numpy.linalg.inv(penalty * numpy.eye(W.shape[1]) + numpy.dot(W.T, W))
+        values -= numpy.dot(W, numpy.dot(J, numpy.dot(W.T, values)))
+        values += plan['ruv_means']
+        return values
+
+    def transform(self, data, tissues=None, chunk_size=None):
+        """
+        Run the pipeline.
+
+        The data are reindexed once into the output buffer and every step
+        works in place on it, one chunk of samples at a time.
+        Note that the 'ruv' step regresses the unwanted factors across the
+        samples in each chunk, so its results depend on the chunk_size.
+
+        Args:
+            data (pandas.DataFrame ~ (num_samples, num_genes))
+            tissues (optional; pandas.Series ~ (num_samples,)): the tissues
+                of the samples, needed by the 'z_score' step.
+            chunk_size (optional; int): the number of samples per chunk.
+                All samples are processed together if None.
+
+        Returns:
+            pandas.DataFrame ~ (num_samples, num_common_genes)
+
+        """
+        plan = self._get_plan()
+        norm = self.normalizer
+        steps = dict(self.steps)
+        genes = plan['genes']
+        if 'z_score' in steps:
+            assert tissues is not None, "The 'z_score' step needs the tissues"
+            codes = plan['tissues'].get_indexer(tissues.reindex(data.index))
+            assert (codes >= 0).all(), "Unknown tissues in tissues"
+        chunk_size = len(data) if chunk_size is None else chunk_size
+
+        values = numpy.empty((len(data), len(genes)), dtype=self.dtype)
+        for start in range(0, len(data), max(1, chunk_size)):
+            stop = start + chunk_size
+            chunk = data.iloc[start:stop]
+            block = values[start:stop]
+            name = self.steps[0][0]
+            norm._tpm_values(chunk, genes, do_nothing, out=block,
+                             lengths=(name == 'tpm_from_counts'))
+            if 'impute' in steps:
+                imputer = steps['impute'].get('imputer', impute)
+                norm._impute_values(block, chunk.index, genes, imputer)
+                # the clr is the same for any scale of the rows
+                if 'clr' not in steps:
+                    norm._normalize_rows(block)
+            if 'clr' in steps:
+                numpy.log(block, out=block)
+                block -= block.mean(axis=1, dtype=numpy.float64, keepdims=True)
+            if 'ruv' in steps:
+                self._ruv_values(block, plan, steps['ruv'].get('penalty', 0))
+            if 'z_score' in steps:
+                _z_score_by_tissue(block, codes[start:stop],
+                                   plan['mean_clr'], plan['std_clr'])
+        return pandas.DataFrame(values, index=data.index, columns=genes)
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        # the normalizer and the plan are rebuilt after loading
+        state['_normalizer'] = None
+        state['_plan'] = None
+        return state
+
+    def save(self, filename, overwrite_existing=False):
+        """
+        Save the pipeline, including any fitted RUV model, to filename.
+
+        Args:
+            filename (string): absolute path to save file
+            overwrite_existing (bool): whether or not to overwrite existing file
+
+        Returns:
+            None
+
+        """
+        path = Path(filename)
+        assert overwrite_existing or not path.exists(), \
+            "Must allow overwriting existing files"
+        with open(filename, 'wb') as f:
+            pickle.dump(self, f)
+
+    @classmethod
+    def load(cls, filename):
+        """
+        Create a pipeline from a saved object.
+
+        Args:
+            filename (str)
+
+        Returns:
+            ExpressionPipeline
+
+        """
+        with open(filename, 'rb') as f:
+            return pickle.load(f)
+
+
+class NormalizationKernel(object):
+    """
+    Fast transforms of a single sample given as a 1-D numpy vector in a fixed
+    gene order. All of the gene lengths and GTEx references are gathered into
+    arrays when the kernel is created, so each call is a handful of numpy
+    operations with no pandas overhead.
+
+    The outputs are in the order of the kernel's genes, which are the input
+    genes that occur in GTEx. The clr and z_score methods take vectors in
+    this order, i.e., the outputs of tpm and clr.
+
+    The mask used to impute zeros is preallocated and reused by every
+    call, so a kernel should not be shared between threads.
+
+    Attributes:
+        genes (pandas.Index): the genes of the outputs.
+        tissue (str): the GTEx tissue of the z-scores.
+        dtype (numpy dtype): the float type of the outputs.
+
+    """
+    def __init__(self, normalizer, genes, tissue=None, dtype=numpy.float64):
+        """
+        Precompute the arrays used to normalize single samples.
+
+        Args:
+            normalizer (Normalizer)
+            genes (List[str]): the gene ids of the input vectors, in order.
+            tissue (optional; str): the GTEx tissue for z-scores.
+            dtype (optional; numpy dtype): the float type of the outputs.
+
+        Returns:
+            NormalizationKernel
+
+        """
+        self.dtype = numpy.dtype(dtype)
+        self.tissue = tissue
+        columns = pandas.Index(genes)
+        self.genes, indexer, lengths = normalizer._reindex_plan(columns, columns)
+        self.num_inputs = len(columns)
+        # skip the gather when the input genes are all in GTEx, in order
+        self._indexer = None
+        if not numpy.array_equal(indexer, numpy.arange(len(columns))):
+            self._indexer = numpy.array(indexer)
+        self._inverse_lengths = (1 / lengths).astype(self.dtype)
+        self._mean = None
+        self._inverse_std = None
+        if tissue is not None:
+            describer = normalizer.describer
+            mean_clr = describer.get_reference('mean_clr', self.genes)[tissue]
+            std_clr = describer.get_reference('std_clr', self.genes)[tissue]
+            self._mean = mean_clr.values.astype(self.dtype)
+            with numpy.errstate(divide='ignore'):
+                self._inverse_std = (1 / std_clr.values).astype(self.dtype)
+        self._zeros = numpy.empty(len(self.genes), dtype=bool)
+
+    def _buffer(self, out):
+        """
+        Get an output vector.
+
+        Args:
+            out (numpy array ~ (num_genes,) or None)
+
+        Returns:
+            numpy array ~ (num_genes,)
+
+        """
+        if out is None:
+            return numpy.empty(len(self.genes), dtype=self.dtype)
+        assert out.shape == (len(self.genes),), \
+            "out must have shape {}".format((len(self.genes),))
+        return out
+
+    def tpm(self, counts, out=None, lengths=True):
+        """
+        Transform a vector of counts (or RPKM, with lengths=False) into TPM.
+
+        Args:
+            counts (numpy array ~ (num_inputs,)): in the order of the input genes.
+            out (optional; numpy array ~ (num_genes,))
+            lengths (optional; bool): whether to divide by the gene lengths.
+
+        Returns:
+            numpy array ~ (num_genes,)
+
+        """
+        out = self._buffer(out)
+        if self._indexer is not None:
+            if counts.dtype == out.dtype:
+                numpy.take(counts, self._indexer, out=out)
+            else:
+                numpy.copyto(out, counts[self._indexer], casting='unsafe')
+            counts = out
+        elif counts.dtype != out.dtype:
+            numpy.copyto(out, counts, casting='unsafe')
+            counts = out
+        if lengths:
+            # the copy and the division by the lengths in one pass
+            numpy.multiply(counts, self._inverse_lengths, out=out)
+        elif counts is not out:
+            numpy.copyto(out, counts)
+        out *= 10**6 / out.sum(dtype=numpy.float64)
+        return out
+
+    def clr(self, tpm, out=None, scale=None):
+        """
+        Compute the centered log ratio transform of a TPM vector.
+
+        Args:
+            tpm (numpy array ~ (num_genes,)): in the order of the kernel genes.
+            out (optional; numpy array ~ (num_genes,)): may be tpm itself.
+            scale (optional; float): if given, zeros are replaced with this
+                fraction of the smallest non-zero value, as in impute.
+
+        Returns:
+            numpy array ~ (num_genes,)
+
+        """
+        out = self._buffer(out)
+        if scale is not None:
+            zeros = numpy.equal(tpm, 0, out=self._zeros)
+            if zeros.any():
+                if out is not tpm:
+                    numpy.copyto(out, tpm, casting='unsafe')
+                # a masked min is slow, so hide the zeros from a plain min
+                numpy.copyto(out, numpy.inf, where=zeros)
+                numpy.copyto(out, scale * out.min(), where=zeros)
+                tpm = out
+        # the log is taken straight from the input into the output
+        numpy.log(tpm, out=out, casting='unsafe')
+        out -= out.sum(dtype=numpy.float64) / len(out)
+        return out
+
+    def z_score(self, clr, out=None):
+        """
+        Compute the z-scores of a clr'd vector relative to the kernel tissue.
+
+        Args:
+            clr (numpy array ~ (num_genes,)): in the order of the kernel genes.
+            out (optional; numpy array ~ (num_genes,)): may be clr itself.
+
+        Returns:
+            numpy array ~ (num_genes,)
+
+        """
+        assert self._mean is not None, "The kernel has no tissue"
+        out = self._buffer(out)
+        numpy.subtract(clr, self._mean, out=out, casting='unsafe')
+        out *= self._inverse_std
+        return out
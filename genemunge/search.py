@@ -15,6 +15,8 @@ class Searcher(object):
     Attributes:
         go (dict): the GO data.
         attributes (dict): gene attributes
+        gene_index (dict): GO ids associated with each ensembl_gene_id,
+            built on first use.
 
     """
     def __init__(self):
@@ -32,6 +34,31 @@ class Searcher(object):
             self.go = json.load(infile)
         with open(ATTRIBUTENAME, 'r') as infile:
             self.attributes = json.load(infile)
+        self._gene_index = None
+
+    @property
+    def gene_index(self):
+        if self._gene_index is None:
+            index = {}
+            for term in self.go:
+                for gene in set(self._get_proteins_from_term(term, None)):
+                    index.setdefault(gene, []).append(term)
+            self._gene_index = index
+        return self._gene_index
+
+    def get_terms(self, gene):
+        """
+        Get all of the GO identifiers associated with a gene
+        for any evidence code.
+
+        Args:
+            gene (str): ensembl_gene_id
+
+        Returns:
+            list of GO ids (List[str])
+
+        """
+        return list(self.gene_index.get(gene, []))
 
     def traverse(self, term, inclusive=True):
         """
@@ -26,6 +26,8 @@ def setup_data():
             "Rscript " + os.path.join(script_path, 'recount.R') + ' ' + script_path,
             shell=True)
     genemunge.data.gtex.process_gtex.create_tissue_stats()
+    genemunge.data.gtex.process_gtex.create_specificity_index()
+    genemunge.data.gtex.process_gtex.create_profile_index()
     genemunge.data.cleanup.remove_installed_data_files()
 
 
@@ -69,12 +71,15 @@ setup(name='genemunge',
                                   'data/go.json',
                                   'data/hgnc_complete_set.txt',
                                   'data/gtex/gene_info.csv',
-                                  'data/gtex/tissue_stats.h5']},
+                                  'data/gtex/tissue_stats.h5',
+                                  'data/gtex/tissue_specificity.h5',
+                                  'data/gtex/tissue_profiles.h5']},
       install_requires=[
           'h5py',
           'matplotlib',
           'numpy',
           'pandas',
+          'scipy',
           'pytest',
           'seaborn',
           'tables',
@@ -1,3 +1,7 @@
+import os
+import numpy as np
+import pandas as pd
+
 from genemunge import describe
 
 import pytest
@@ -9,6 +13,23 @@ def test_describe_construct():
     desc.close()
 
 
+def test_describe_lazy_tissue_stats():
+    """Check that the tissue statistics are only read on first access."""
+    desc = describe.Describer(identifier='symbol')
+    assert not desc.tissue_stats.is_loaded('mean')
+    mean = desc.tissue_stats['mean']
+    assert desc.tissue_stats.is_loaded('mean')
+    assert not desc.tissue_stats.is_loaded('std')
+    assert desc.tissue_stats['mean'] is mean
+
+
+def test_describe_preload_tissue_stats():
+    """Check that preloading reads all of the tissue statistics."""
+    desc = describe.Describer(identifier='symbol', preload=True)
+    desc.close()
+    assert all(desc.tissue_stats.is_loaded(k) for k in desc.__stats__)
+
+
 def test_describe_get_tissue_expression():
     """Try to get the tissue expression statistics for a given gene."""
     gene_name = 'TP53'
@@ -27,6 +48,121 @@ def test_describe_get_tissue_expression_unknown():
     assert False
 
 
+def test_describe_get_tissue_expression_panel():
+    """Check that the batch lookup matches the single gene lookup."""
+    gene_names = ['TP53', 'foo', 'BRCA1']
+    desc = describe.Describer(identifier='symbol')
+    panel = desc.get_tissue_expression_panel(gene_names)
+    expression = desc.get_tissue_expression('TP53')
+    assert panel.shape == (3, len(desc.tissues), expression.shape[1])
+    assert np.allclose(panel[0], expression.loc[desc.tissues].values)
+    assert np.isnan(panel[1]).all()
+
+    frame = desc.get_tissue_expression_panel(gene_names, stats=['mean'],
+                                             as_frame=True)
+    assert np.allclose(frame.loc['BRCA1']['mean'], panel[2, :, 0])
+
+
+def test_describe_plot_tissue_expression_batch(tmpdir):
+    """Try to render tissue expression plots for many genes."""
+    gene_names = ['TP53', 'BRCA1', 'foo']
+    desc = describe.Describer(identifier='symbol')
+    with pytest.warns(UserWarning):
+        filenames = desc.plot_tissue_expression_batch(
+                gene_names, directory=str(tmpdir), sortby='median', n_jobs=2)
+    assert [os.path.basename(f) for f in filenames] == ['TP53.png', 'BRCA1.png']
+    assert all(os.path.exists(f) for f in filenames)
+
+    pdf = str(tmpdir.join('report.pdf'))
+    with pytest.warns(UserWarning):
+        desc.plot_tissue_expression_batch(gene_names, filename=pdf)
+    assert os.path.exists(pdf)
+
+
+def test_describe_specificity():
+    """Check the top-k and rank queries of the tissue specificity index."""
+    desc = describe.Describer(identifier='ensembl_gene_id')
+    tissue = desc.tissues[0]
+    top = desc.get_specific_genes(tissue, k=5, score='fraction')
+    assert len(top) == 5
+    assert [desc.get_specificity_rank(g, tissue, score='fraction')
+            for g in top] == list(range(5))
+
+    mean = desc.tissue_stats['mean']
+    fraction = mean[tissue] / mean.sum(axis=1)
+    assert np.all(np.diff(fraction.loc[top].values) <= 1e-6)
+
+    # the genes are returned with the identifier of the Describer
+    desc_symbol = describe.Describer(identifier='symbol')
+    top_symbol = desc_symbol.get_specific_genes(tissue, k=5, score='fraction')
+    assert len(top_symbol) == 5
+    assert [desc_symbol.get_specificity_rank(g, tissue, score='fraction')
+            for g in top_symbol] == list(range(5))
+    assert desc_symbol.get_ensembl(top_symbol[0]) in top
+
+
+def test_describe_classify_tissue():
+    """Check that samples drawn from the GTEx CLR statistics of a tissue
+    are assigned to that tissue."""
+    desc = describe.Describer(identifier='symbol')
+    mean_clr = desc.get_reference('mean_clr').iloc[:2000]
+    std_clr = desc.get_reference('std_clr').loc[mean_clr.index]
+    tissues = pd.Series(np.random.choice(desc.tissues, size=20))
+    noise = np.random.randn(len(tissues), len(mean_clr))
+    data = pd.DataFrame(mean_clr[tissues].values.T + noise * std_clr[tissues].values.T,
+                        columns=mean_clr.index)
+
+    result = desc.classify_tissue(data, tissues=tissues, chunk_size=7)
+    assert (result['tissue'] == tissues).all()
+    assert (result['declared_rank'] == 0).all()
+    assert (result['margin'] > 0).all()
+
+
+def test_describe_deconvolve():
+    """Check that mixtures of GTEx tissue profiles are deconvolved."""
+    desc = describe.Describer(identifier='symbol')
+    mean = desc.get_reference('mean').iloc[:2000]
+    num_samples = 10
+    true_proportions = np.random.dirichlet(np.ones(len(desc.tissues)), num_samples)
+    data = pd.DataFrame(np.dot(true_proportions, mean.values.T), columns=mean.index)
+
+    proportions, residuals = desc.deconvolve(data, chunk_size=3)
+    assert np.allclose(proportions.values, true_proportions, atol=1e-4)
+    assert np.allclose(residuals, 0, atol=1e-4)
+    assert list(proportions.columns) == desc.tissues
+
+
+def test_describe_get_similar_genes():
+    """Check the nearest neighbors of gene expression profiles against
+    a brute force calculation."""
+    desc = describe.Describer(identifier='ensembl_gene_id')
+    mean_clr = desc.tissue_stats['mean_clr']
+    queries = list(mean_clr.index[[0, 100, 5000]])
+    neighbors = desc.get_similar_genes(queries, k=5, block_size=1000)
+    assert len(neighbors) == len(queries)
+
+    values = mean_clr.values.astype(np.float64)
+    values -= values.mean(axis=1, keepdims=True)
+    values /= np.linalg.norm(values, axis=1, keepdims=True)
+    correlations = np.dot(values[[0, 100, 5000]], values.T)
+    for i, q in enumerate(queries):
+        expected = pd.Series(correlations[i], index=mean_clr.index).drop(q)
+        expected = expected.sort_values(ascending=False)[:5]
+        assert np.allclose(neighbors[i].values, expected.values, atol=1e-5)
+        assert q not in neighbors[i].index
+
+    # duplicate and unknown queries keep their place, with symbols as ids
+    desc_symbol = describe.Describer(identifier='symbol')
+    symbols = list(desc_symbol.get_reference('mean_clr').index[:2])
+    queries = [symbols[0], 'not_a_gene', symbols[1], symbols[0]]
+    with pytest.warns(UserWarning):
+        neighbors = desc_symbol.get_similar_genes(queries, k=5)
+    assert len(neighbors) == 4
+    assert len(neighbors[1]) == 0
+    assert neighbors[0].equals(neighbors[3])
+    assert neighbors[0].index.isin(desc_symbol.get_reference('mean_clr').index).all()
+
+
 def test_describe_get_gene_info():
     """Try to get name and GO info for a given gene."""
     gene_name = 'TP53'
@@ -34,5 +170,21 @@ def test_describe_get_gene_info():
     gene_info = desc.get_gene_info(gene_name)
 
 
+
+def test_describe_get_gene_info_table():
+    """Check that the batch gene info matches the single gene lookup."""
+    gene_names = ['TP53', 'foo', 'TP53']
+    desc = describe.Describer(identifier='symbol')
+    gene_info = desc.get_gene_info('TP53')
+    table = desc.get_gene_info_table(gene_names)
+    assert list(table.index) == gene_names
+    assert table.iloc[0]['ensembl'] == gene_info['ensembl']
+    assert table.iloc[0]['name'] == gene_info['name']
+    terms = sum([table.iloc[0][n] for n in ['biological_process',
+                 'molecular_function', 'cellular_component']], [])
+    assert sorted(terms) == sorted(gene_info['ontology'])
+    assert table.iloc[1]['ensembl'] != table.iloc[1]['ensembl']
+
+
 if __name__ == "__main__":
     pytest.main([__file__])
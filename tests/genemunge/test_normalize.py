@@ -4,6 +4,9 @@ from collections import namedtuple
 
 from genemunge import normalize
 
+import scipy.sparse
+from scipy import stats
+
 import pytest
 
 np.random.seed(137)
@@ -42,6 +45,24 @@ def test_deduplicate():
     assert np.allclose(x[:, [2, 4]].sum(axis=1), df_dedup.values[:,1])
     assert np.allclose(x[:, 3], df_dedup.values[:,2])
 
+    df_mean = normalize.deduplicate(df, how='mean')
+    assert list(df_mean.columns) == ['a', 'b', 'c']
+    assert np.allclose(x[:, [2, 4]].mean(axis=1), df_mean['b'])
+    df_max = normalize.deduplicate(df, how='max')
+    assert np.allclose(x[:, [0, 1]].max(axis=1), df_max['a'])
+
+    df_unique = df.iloc[:, 1:4]
+    assert normalize.deduplicate(df_unique) is df_unique
+
+    # sums and maxima of counts stay integers, like the unique columns
+    counts = pd.DataFrame(np.random.randint(0, 100, size=(10, 5)), columns=df.columns)
+    counts_dedup = normalize.deduplicate(counts)
+    assert (counts_dedup.dtypes == np.int64).all()
+    assert (counts_dedup['a'] == counts.iloc[:, 0] + counts.iloc[:, 1]).all()
+    assert (normalize.deduplicate(counts, how='max').dtypes == np.int64).all()
+    assert (normalize.deduplicate(df.astype(np.float32)).dtypes == np.float32).all()
+    assert (normalize.deduplicate(counts, how='mean').dtypes == np.float64).all()
+
 
 def test_impute(expression_data):
     """Check the imputation of some expression data."""
@@ -57,6 +78,15 @@ def test_impute(expression_data):
                        imputed_data * ~zero_mask)
 
 
+def test_normalizer_lazy_describer(expression_data):
+    """Check that the Describer is only created when GTEx stats are needed."""
+    norm = normalize.Normalizer(identifier='symbol')
+    assert norm._describer is None
+    tpm = norm.tpm_from_counts(expression_data.counts)
+    assert norm._describer is None
+    assert norm.describer is norm.describer
+
+
 def test_normalizer_tpm_from_rpkm(expression_data):
     """Test the RPKM -> TPM conversion for some expression data."""
     identifier = 'symbol'
@@ -111,6 +141,114 @@ def test_normalizer_tpm_from_counts_allgenes(expression_data):
     assert np.allclose(tpm.values, tpm_calc[expression_data.tpm.columns].values)
 
 
+def test_normalizer_tpm_from_counts_out(expression_data):
+    """Check that the counts -> TPM conversion writes into a given buffer."""
+    identifier = 'symbol'
+    norm = normalize.Normalizer(identifier=identifier)
+
+    counts = expression_data.counts
+    tpm = expression_data.tpm
+    out = np.empty(counts.shape)
+    tpm_calc = norm.tpm_from_counts(counts, counts.columns, out=out)
+
+    assert np.shares_memory(tpm_calc.values, out)
+    assert np.allclose(tpm.values, out)
+
+
+@pytest.mark.parametrize("extension", ['.csv', '.h5', '.parquet'])
+def test_normalizer_transform_file(expression_data, tmpdir, extension):
+    """Check that streaming a file in chunks matches the in-memory transform."""
+    if extension == '.parquet':
+        pytest.importorskip('pyarrow')
+    identifier = 'symbol'
+    norm = normalize.Normalizer(identifier=identifier)
+
+    counts = expression_data.counts
+    counts.index = ['sample_{}'.format(i) for i in range(len(counts))]
+    input_file = str(tmpdir.join('counts' + extension))
+    output_file = str(tmpdir.join('tpm' + extension))
+    with normalize.ChunkWriter(input_file) as writer:
+        writer.write(counts)
+
+    report = norm.transform_file(input_file, output_file, 'tpm_from_counts',
+                                 chunk_size=30, gene_list=counts.columns)
+    assert report['rows'] == len(counts)
+    tpm_calc = pd.concat(list(normalize.read_chunks(output_file, chunk_size=40)))
+    assert (tpm_calc.index == counts.index).all()
+    assert np.allclose(expression_data.tpm.values, tpm_calc.values)
+
+
+@pytest.mark.parametrize("hdf_format", ['fixed', 'table'])
+def test_read_chunks_hdf(expression_data, tmpdir, hdf_format):
+    """Check that plain HDF5 frames are read back in chunks."""
+    # table format only holds a limited number of columns
+    counts = expression_data.counts.iloc[:, :50]
+    counts.index = ['sample_{}'.format(i) for i in range(len(counts))]
+    filename = str(tmpdir.join('counts.h5'))
+    counts.to_hdf(filename, 'data', format=hdf_format)
+
+    chunks = list(normalize.read_chunks(filename, chunk_size=30))
+    assert all(len(chunk) <= 30 for chunk in chunks)
+    assert len(chunks) == -(-len(counts) // 30)
+    pd.testing.assert_frame_equal(pd.concat(chunks), counts)
+
+
+def test_normalizer_sparse(expression_data):
+    """Check that sparse counts give the same TPM and CLR as dense counts."""
+    identifier = 'symbol'
+    norm = normalize.Normalizer(identifier=identifier)
+    counts = expression_data.counts
+    sparse_counts = scipy.sparse.csr_matrix(counts.values)
+
+    tpm = norm.tpm_from_counts(counts)
+    tpm_sparse = norm.tpm_from_counts(sparse_counts, columns=counts.columns)
+    assert scipy.sparse.issparse(tpm_sparse)
+    assert tpm_sparse.shape == tpm.shape
+    assert (norm.common_genes() == tpm.columns).all()
+    assert np.allclose(tpm.values, tpm_sparse.toarray())
+
+    reindexed = norm.reindex(sparse_counts, columns=counts.columns)
+    assert np.allclose(norm.reindex(counts).values, reindexed.toarray())
+
+    clr = norm.clr_from_tpm(tpm, imputer=normalize.impute)
+    clr_chunks = pd.concat(list(norm.iter_dense_chunks(
+        tpm_sparse, tpm.columns, 'clr_from_tpm', index=counts.index,
+        chunk_size=30, imputer=normalize.impute)))
+    assert (clr_chunks.index == counts.index).all()
+    assert np.allclose(clr.values, clr_chunks.values)
+
+
+def test_normalizer_float32(expression_data):
+    """Quantify the precision lost by computing in float32."""
+    identifier = 'symbol'
+    norm = normalize.Normalizer(identifier=identifier)
+    norm32 = normalize.Normalizer(identifier=identifier, dtype=np.float32)
+    counts = expression_data.counts
+    genes = counts.columns
+
+    tpm = norm.tpm_from_counts(counts, gene_list=genes)
+    tpm32 = norm32.tpm_from_counts(counts, gene_list=genes)
+    assert (tpm32.dtypes == np.float32).all()
+    assert np.allclose(tpm32.values, tpm.values, rtol=1e-6, atol=0)
+    assert np.allclose(tpm32.sum(axis=1), 1e6, rtol=1e-6)
+    assert (norm.tpm_from_counts(counts, gene_list=genes, dtype=np.float32).dtypes
+            == np.float32).all()
+
+    clr = norm.clr_from_tpm(tpm, imputer=normalize.impute)
+    clr32 = norm32.clr_from_tpm(tpm32, imputer=normalize.impute)
+    assert (clr32.dtypes == np.float32).all()
+    assert np.abs(clr32.values - clr.values).max() < 1e-5
+    assert np.abs(clr32.mean(axis=1)).max() < 1e-5
+
+    tissues = pd.Series('Liver', index=clr.index)
+    zscore = norm.z_score_from_clr(clr, tissues, gene_list=genes)
+    zscore32 = norm32.z_score_from_clr(clr32, tissues, gene_list=genes)
+    assert (zscore32.dtypes == np.float32).all()
+    finite = np.isfinite(zscore.values)
+    assert np.allclose(zscore32.values[finite], zscore.values[finite],
+                       rtol=1e-4, atol=1e-4)
+
+
 def test_normalizer_tpm_from_subset(expression_data):
     """Test the TPM -> TPM subset conversion for some expression data."""
     identifier = 'symbol'
@@ -173,6 +311,27 @@ def test_alr_functions_dirimpute(expression_data):
     assert (genes_to_keep == alr_genes)
 
 
+def test_alr_reference_panels(expression_data):
+    """Test the ALR transform with several reference panels in one call."""
+    identifier = 'symbol'
+    norm = normalize.Normalizer(identifier=identifier)
+
+    tpm = normalize.impute(expression_data.tpm)
+    all_genes = list(tpm.columns)
+    panels = {'first': all_genes[:1], 'pair': all_genes[2:4]}
+    alr = norm.alr_from_tpm(tpm, panels, gene_list=all_genes)
+    assert set(alr) == set(panels)
+
+    log_tpm = np.log(tpm)
+    for name, references in panels.items():
+        expected = log_tpm.drop(columns=references).subtract(
+                log_tpm[references].mean(axis=1), axis=0)
+        assert list(alr[name].columns) == list(expected.columns)
+        assert np.allclose(alr[name].values, expected.values)
+        single = norm.alr_from_tpm(tpm, references, gene_list=all_genes)
+        assert np.allclose(single.values, expected.values)
+
+
 def test_gtex_reindex(expression_data):
     """Test that all of the transforms reindex to GTEx properly."""
     identifier = 'symbol'
@@ -182,6 +341,12 @@ def test_gtex_reindex(expression_data):
     assert (tpm.columns == clr.columns).all()
     assert (tpm.columns == norm.gene_lengths.index).all()
 
+    # integer counts keep their type unless genes need to be filled in
+    counts = expression_data.counts.round().astype(np.int64)
+    common = counts.loc[:, counts.columns.isin(norm.common_genes())]
+    assert (norm.reindex(common, gene_list=common.columns).dtypes == np.int64).all()
+    assert (norm.reindex(counts).dtypes == norm.dtype).all()
+
 
 def test_zscore_from_clr(expression_data):
     """Test the z-score transformation on CLR data."""
@@ -195,6 +360,230 @@ def test_zscore_from_clr(expression_data):
     zscore = norm.z_score_from_clr(clr, tissues)
     assert zscore.shape == clr.shape
 
+    # genes without GTEx statistics are NaN
+    zscore = norm.z_score_from_clr(clr, tissues,
+                                   gene_list=list(clr.columns) + ['not_a_gene'])
+    assert zscore.shape == (len(clr), len(clr.columns) + 1)
+    assert zscore['not_a_gene'].isnull().all()
+
+    # samples from several tissues, given in a different order than the data
+    tissues = pd.Series(np.resize(['Liver', 'Lung', 'Brain'], len(clr)),
+                        index=clr.index)[::-1]
+    zscore = norm.z_score_from_clr(clr, tissues)
+    mean_clr = norm.describer.get_reference('mean_clr').reindex(clr.columns)
+    std_clr = norm.describer.get_reference('std_clr').reindex(clr.columns)
+    for sample in clr.index[:5]:
+        tissue = tissues[sample]
+        expected = (clr.loc[sample] - mean_clr[tissue]) / std_clr[tissue]
+        assert np.allclose(zscore.loc[sample], expected, equal_nan=True)
+
+
+def test_gene_length_cache(tmpdir, monkeypatch):
+    """Check that the gene lengths are cached on disk and memory-mapped."""
+    monkeypatch.setenv('GENEMUNGE_CACHE', str(tmpdir))
+    monkeypatch.setattr(normalize, '_gene_lengths', {})
+    identifier = 'symbol'
+    expected = normalize._read_gene_lengths(identifier)
+
+    norm = normalize.Normalizer(identifier=identifier)
+    assert len(tmpdir.listdir()) == 2
+    assert norm.gene_lengths.equals(expected)
+
+    # a fresh process only has the files on disk
+    monkeypatch.setattr(normalize, '_gene_lengths', {})
+    norm = normalize.Normalizer(identifier=identifier)
+    assert isinstance(norm.gene_lengths.values, np.memmap)
+    assert (norm.gene_lengths.index == expected.index).all()
+    assert (norm.gene_lengths.values == expected.values).all()
+
+
+def test_reindex_plan_cache(expression_data):
+    """Check that reindex plans are reused and evicted least recently used first."""
+    identifier = 'symbol'
+    norm = normalize.Normalizer(identifier=identifier, plan_cache_size=2)
+    counts = expression_data.counts
+    gene_list = list(counts.columns) + ['not_a_gene']
+
+    with pytest.warns(UserWarning, match='not_a_gene'):
+        first = norm.tpm_from_counts(counts, gene_list=gene_list)
+    plan = norm._reindex_plan(counts.columns, gene_list)
+    with pytest.warns(UserWarning, match='not_a_gene'):
+        second = norm.tpm_from_counts(counts, gene_list=gene_list)
+    assert len(norm._plans) == 1
+    assert norm._reindex_plan(counts.columns, gene_list)[1] is plan[1]
+    assert np.allclose(first.values, second.values)
+
+    norm.reindex(counts)
+    norm.reindex(counts.iloc[:, ::-1])
+    assert len(norm._plans) == 2
+    assert norm._reindex_plan(counts.columns, gene_list)[1] is not plan[1]
+
+    # equal labels reuse the plan, while a layout with the same length and
+    # end labels does not
+    columns = pd.Index(list(counts.columns))
+    plan = norm._reindex_plan(columns, columns)
+    assert norm._reindex_plan(columns.copy(), list(columns))[1] is plan[1]
+    swapped = list(columns)
+    swapped[1], swapped[2] = swapped[2], swapped[1]
+    swapped = pd.Index(swapped)
+    indexer = norm._reindex_plan(swapped, columns)[1]
+    assert indexer is not plan[1]
+    assert (swapped[indexer] == columns[plan[1]]).all()
+
+
+def test_normalizer_n_jobs(expression_data):
+    """Check that splitting rows across threads gives the same results."""
+    identifier = 'symbol'
+    norm = normalize.Normalizer(identifier=identifier)
+    counts = expression_data.counts
+
+    tpm = norm.tpm_from_counts(counts, gene_list=counts.columns)
+    tpm_threaded = norm.tpm_from_counts(counts, gene_list=counts.columns, n_jobs=3)
+    assert np.allclose(tpm.values, tpm_threaded.values)
+
+    clr = norm.clr_from_tpm(tpm, imputer=normalize.impute)
+    clr_threaded = norm.clr_from_tpm(tpm, imputer=normalize.impute, n_jobs=3)
+    assert np.allclose(clr.values, clr_threaded.values)
+
+    tissues = pd.Series('Liver', index=clr.index)
+    zscore = norm.z_score_from_clr(clr, tissues, gene_list=counts.columns)
+    zscore_threaded = norm.z_score_from_clr(clr, tissues, gene_list=counts.columns,
+                                            n_jobs=3)
+    assert np.allclose(zscore.values, zscore_threaded.values, equal_nan=True)
+
+
+def test_imputers():
+    """Check the in-place imputers against direct calculations."""
+    x = np.random.rand(10, 6)
+    x[x < 0.3] = 0
+    x[0, 1] = np.nan
+    x[1] = 0
+    df = pd.DataFrame(x, columns=list('abcdef'))
+
+    # the original pandas implementation of impute
+    v = 0.5 * df[df > 0].min(axis=1)
+    df_fill = df.fillna(0)
+    expected = df_fill + (df_fill == 0).multiply(v, axis=0)
+    assert np.allclose(normalize.impute(df), expected, equal_nan=True)
+    values = x.copy()
+    imputed = normalize.impute(values, inplace=True)
+    assert imputed is values
+    assert np.allclose(imputed, expected, equal_nan=True)
+
+    replaced = normalize.multiplicative_replacement(x[2:], delta=0.01)
+    assert np.allclose(replaced.sum(axis=1), np.nansum(x[2:], axis=1))
+    assert np.allclose(replaced[x[2:] == 0],
+                       0.01 * np.nansum(x[2:], axis=1)[np.nonzero(x[2:] == 0)[0]])
+    assert (replaced > 0).all()
+
+    assert np.allclose(normalize.pseudocount(df, 1), df.fillna(0) + 1)
+
+
+def test_detection_imputer(expression_data):
+    """Check that the detection-aware imputer scales the imputed values."""
+    identifier = 'symbol'
+    norm = normalize.Normalizer(identifier=identifier)
+    tpm = expression_data.tpm.copy()
+    tpm.iloc[:, :10] = 0
+
+    imputer = normalize.DetectionImputer('Liver', identifier=identifier)
+    imputed = norm.tpm_from_subset(tpm, gene_list=tpm.columns, imputer=imputer)
+    detection = imputer.detection(tpm.columns)
+    row_min = tpm[tpm > 0].min(axis=1)
+    expected = tpm.where(tpm > 0, 0.5 * np.outer(row_min, detection))
+    expected = expected.divide(expected.sum(axis=1) / 1e6, axis=0)
+    assert np.allclose(imputed.values, expected.values)
+    assert ((detection >= 0.01) & (detection <= 1)).all()
+
+
+def test_benjamini_hochberg():
+    """Check the Benjamini-Hochberg adjustment on a small example."""
+    pvalues = np.array([[0.01, 0.04, 0.03, 0.005], [0.5, 0.2, np.nan, 0.01]])
+    expected = np.array([[0.02, 0.04, 0.04, 0.02], [0.5, 0.3, np.nan, 0.03]])
+    assert np.allclose(normalize.benjamini_hochberg(pvalues), expected,
+                       equal_nan=True)
+
+
+def test_differential_expression():
+    """Compare the vectorized tests to scipy on random data."""
+    num_samples = 40
+    num_genes = 25
+    data = pd.DataFrame(np.round(np.random.randn(num_samples, num_genes), 1))
+    groups = pd.Series(np.repeat(['a', 'b', 'c', 'd'], num_samples // 4))
+    a, b = data.values[groups == 'a'], data.values[groups == 'b']
+
+    welch = normalize.differential_expression(data, groups, chunk_size=7)
+    assert len(welch) == 6
+    expected = stats.ttest_ind(a, b, equal_var=False)
+    assert np.allclose(welch[('a', 'b')]['statistic'], expected.statistic)
+    assert np.allclose(welch[('a', 'b')]['p_value'], expected.pvalue)
+
+    # a large offset relative to the spread must not lose the variances
+    shifted = normalize.differential_expression(1e8 + data, groups,
+                                                contrasts=[('a', 'b')])
+    assert np.allclose(shifted[('a', 'b')]['statistic'], expected.statistic,
+                       rtol=1e-4)
+
+    mannwhitney = normalize.differential_expression(
+            data, groups, contrasts=[('a', 'b')], test='mannwhitney', chunk_size=7)
+    expected = stats.mannwhitneyu(a, b, alternative='two-sided')
+    assert np.allclose(mannwhitney[('a', 'b')]['p_value'], expected.pvalue)
+
+
+def test_outliers_from_clr(expression_data):
+    """Check that the outliers are the significant entries of the z-scores."""
+    identifier = 'symbol'
+    norm = normalize.Normalizer(identifier=identifier)
+
+    tpm = normalize.impute(expression_data.tpm)
+    clr = norm.clr_from_tpm(tpm, gene_list=tpm.columns)
+    tissues = pd.Series('Liver', index=clr.index)
+    zscore = norm.z_score_from_clr(clr, tissues)
+
+    outliers = norm.outliers_from_clr(clr, tissues, alpha=0.05, chunk_size=30)
+    assert (outliers['q_value'] <= 0.05).all()
+    assert np.allclose(outliers['z_score'].values,
+                       [zscore.loc[s, g] for s, g in zip(outliers['sample'], outliers['gene'])])
+    expected = normalize.benjamini_hochberg(
+            2 * stats.norm.sf(np.abs(zscore.values)))
+    assert len(outliers) == (expected <= 0.05).sum()
+
+
+def test_percentile_ranks():
+    """Compare the percentile ranks to an exact calculation
+    when the quantiles are the reference data itself."""
+    num_genes = 50
+    reference = np.sort(np.random.randn(num_genes, 101), axis=1)
+    data = 1.5 * np.random.randn(20, num_genes)
+    percentiles = normalize.percentile_ranks(data, reference)
+    expected = np.array([[np.interp(data[i, g], reference[g], np.arange(101))
+                          for g in range(num_genes)] for i in range(len(data))])
+    assert np.allclose(percentiles, expected)
+
+
+def test_percentile_from_clr(expression_data):
+    """Check the percentiles of CLR data against the GTEx quantiles."""
+    identifier = 'symbol'
+    norm = normalize.Normalizer(identifier=identifier)
+
+    tpm = normalize.impute(expression_data.tpm)
+    clr = norm.clr_from_tpm(tpm, gene_list=tpm.columns)
+    tissues = pd.Series(['Liver', 'Lung'] * (len(clr) // 2), index=clr.index)
+    percentiles = norm.percentile_from_clr(clr, tissues)
+    assert percentiles.shape == clr.shape
+    known = percentiles.stack()
+    assert ((known >= 0) & (known <= 100)).all()
+
+    # genes without a sketch have NaN percentiles
+    unknown = norm.percentile_from_clr(clr.assign(not_a_gene=0.0), tissues)
+    assert unknown['not_a_gene'].isnull().all()
+
+    quantiles = norm.describer.get_reference('quantiles_clr')
+    gene = clr.columns[0]
+    minimum = quantiles.loc[gene].xs(0, level=1)
+    below = clr[gene] < minimum[tissues].values
+    assert (percentiles[gene][below] == 0).all()
+
 
 def test_ordinalize(expression_data):
     """Test the ordinalize transformation on CLR data."""
@@ -211,6 +600,120 @@ def test_ordinalize(expression_data):
     assert ((clr > cutoffs[0]) == (ords == 1+min_value)).all().all()
 
 
+def test_ordinalize_per_gene(expression_data):
+    """Test ordinalize with per-gene cutoffs from the GTEx quartiles."""
+    identifier = 'symbol'
+    norm = normalize.Normalizer(identifier=identifier)
+
+    tpm = normalize.impute(expression_data.tpm)
+    clr = norm.clr_from_tpm(tpm, gene_list=tpm.columns)
+
+    quartiles = norm.gtex_cutoffs('Liver', gene_list=clr.columns)
+    assert list(quartiles.columns) == ['lower_quartile', 'median', 'upper_quartile']
+    assert (quartiles.index == clr.columns).all()
+
+    # increasing cutoffs for the genes that have GTEx quartiles
+    steps = np.random.rand(*quartiles.shape) + 0.1
+    cutoffs = pd.DataFrame(np.cumsum(steps, axis=1) - 1.5, index=quartiles.index,
+                           columns=quartiles.columns).where(quartiles.notnull())
+    ords = norm.ordinalize(clr, cutoffs, min_value=-1, dtype=np.int8, block_size=30)
+    assert (ords.dtypes == np.int8).all()
+    assert ords.shape == clr.shape
+
+    known = cutoffs.notnull().all(axis=1)
+    gene = known[known].index[0]
+    expected = np.searchsorted(cutoffs.loc[gene].values, clr[gene].values) - 1
+    assert (ords[gene].values == expected).all()
+    assert (ords.loc[:, ~known.values] == -1).all().all()
+
+    global_ords = norm.ordinalize(clr, [-1, 0, 1], dtype=np.int8, block_size=30)
+    assert (global_ords.values == norm.ordinalize(clr, [-1, 0, 1]).values).all()
+
+
+def test_normalization_kernel(expression_data):
+    """Compare the single-sample kernel to the DataFrame transforms."""
+    identifier = 'symbol'
+    norm = normalize.Normalizer(identifier=identifier)
+    counts = expression_data.counts
+    genes = list(counts.columns[::-1]) + ['not_a_gene']
+    counts = counts.assign(not_a_gene=1.0)[genes]
+
+    tpm = norm.tpm_from_counts(counts, gene_list=genes)
+    clr = norm.clr_from_tpm(tpm, gene_list=tpm.columns, imputer=normalize.impute)
+    tissues = pd.Series('Liver', index=clr.index)
+    zscore = norm.z_score_from_clr(clr, tissues)
+
+    kernel = norm.kernel(genes, tissue='Liver')
+    assert (kernel.genes == tpm.columns).all()
+    buffer = np.empty(len(kernel.genes))
+    for i in range(3):
+        sample = counts.values[i]
+        assert np.allclose(kernel.tpm(sample, out=buffer), tpm.values[i])
+        assert np.allclose(kernel.clr(buffer, out=buffer, scale=0.5), clr.values[i])
+        assert np.allclose(kernel.z_score(buffer, out=buffer), zscore.values[i],
+                           equal_nan=True)
+
+    # zeros are imputed into a separate output without changing the input
+    sample = kernel.tpm(counts.values[0])
+    sample[:10] = 0
+    expected = np.log(np.where(sample == 0, 0.5 * sample[sample > 0].min(), sample))
+    expected -= expected.mean()
+    assert np.allclose(kernel.clr(sample, scale=0.5), expected)
+    assert (sample[:10] == 0).all()
+    assert np.allclose(kernel.clr(sample, out=sample, scale=0.5), expected)
+
+
+def test_expression_pipeline(expression_data, tmpdir):
+    """Compare the fused pipeline to the individual transforms."""
+    identifier = 'symbol'
+    norm = normalize.Normalizer(identifier=identifier)
+    counts = expression_data.counts
+    genes = list(counts.columns)
+    tissues = pd.Series(np.resize(['Liver', 'Lung'], len(counts)), index=counts.index)
+
+    tpm = normalize.impute(norm.tpm_from_counts(counts, gene_list=genes))
+    clr = norm.clr_from_tpm(tpm, gene_list=genes)
+    ruv = normalize.RemoveUnwantedVariation()
+    ruv_clr = ruv.fit_transform(clr, genes[:100], num_components=5)
+    zscore = norm.z_score_from_clr(ruv_clr, tissues, gene_list=genes)
+
+    pipeline = normalize.ExpressionPipeline(
+        ['tpm_from_counts', 'impute', 'clr', ('ruv', {'model': ruv}), 'z_score'],
+        identifier=identifier, gene_list=genes)
+    result = pipeline.transform(counts, tissues)
+    zscore = zscore[result.columns]
+    assert np.allclose(result.values, zscore.values, equal_nan=True)
+
+    filename = str(tmpdir.join('pipeline.pkl'))
+    pipeline.save(filename)
+    loaded = normalize.ExpressionPipeline.load(filename)
+    assert np.allclose(loaded.transform(counts, tissues).values, zscore.values,
+                       equal_nan=True)
+
+    clr_pipeline = normalize.ExpressionPipeline(['tpm_from_counts', 'impute', 'clr'],
+                                                identifier=identifier, gene_list=genes)
+    assert np.allclose(clr_pipeline.transform(counts, chunk_size=30).values, clr.values)
+
+    # imputed tpm is renormalized only when it is the output
+    tpm_pipeline = normalize.ExpressionPipeline(['tpm_from_counts', 'impute'],
+                                                identifier=identifier, gene_list=genes)
+    assert np.allclose(tpm_pipeline.transform(counts).values, tpm.values)
+
+    # pipelines with a detection imputer can be pickled
+    imputer = normalize.DetectionImputer('Liver', identifier=identifier)
+    detection_pipeline = normalize.ExpressionPipeline(
+        ['tpm_from_counts', ('impute', {'imputer': imputer}), 'clr'],
+        identifier=identifier, gene_list=genes)
+    expected = detection_pipeline.transform(counts)
+    filename = str(tmpdir.join('detection.pkl'))
+    detection_pipeline.save(filename)
+    loaded = normalize.ExpressionPipeline.load(filename)
+    assert np.allclose(loaded.transform(counts).values, expected.values)
+
+    with pytest.raises(AssertionError):
+        normalize.ExpressionPipeline(['clr', 'tpm_from_counts'])
+
+
 def test_remove_unwanted_variation_noX():
     """Test the RUV2 implementation for data with no X."""
     num_samples = 100
@@ -41,6 +41,14 @@ def test_searcher_get_genes_allbp():
     all_bp_genes = searcher.get_genes(ids)
 
 
+def test_searcher_get_terms():
+    """Check that the genes of a term map back to the term."""
+    searcher = search.Searcher()
+    bp_genes = searcher.get_genes([biological_process_id])
+    assert all(biological_process_id in searcher.get_terms(g) for g in bp_genes)
+    assert searcher.get_terms('foo') == []
+
+
 def test_searcher_get_housekeeping_genes():
     """Try to get the list of housekeeping genes.  Check a known HK gene."""
     searcher = search.Searcher()